@@ -1,6 +1,6 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from pathlib import Path
 from pydantic import BaseModel
 from typing import Optional, List, Dict
@@ -9,10 +9,17 @@ import os
 import zipfile
 import io
 from datetime import datetime
-from openai import AzureOpenAI
 from dotenv import load_dotenv
 import base64
 import random
+import asyncio
+from llm_client import chat_completion, close_async_client, stream_chat_completion
+from llm_governor import INTERACTIVE, get_llm_governor
+from llm_cache import get_llm_cache
+from docx_extract import extract_docx_text
+from extraction_pool import run_extraction, shutdown_extraction_pool
+from json_extract import extract_json
+from metrics import CONTENT_TYPE, agent_span, install_http_metrics, instrument_agent, record_agent_error, record_parse_failure, render_metrics
 
 # OCR Support
 try:
@@ -23,12 +30,8 @@ except ImportError:
     OCR_AVAILABLE = False
     print("Warning: pytesseract/PIL not available. OCR will be simulated.")
 
-try:
-    from docx import Document
-    DOCX_AVAILABLE = True
-except ImportError:
-    DOCX_AVAILABLE = False
-    print("Warning: python-docx not available.")
+# DOCX text is read by docx_extract with the standard library (python-docx is not needed)
+DOCX_AVAILABLE = True
 
 # Load environment variables
 load_dotenv()
@@ -64,6 +67,7 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
     expose_headers=["*"],
 )
+install_http_metrics(app)
 
 # Add OPTIONS handler for CORS preflight
 @app.options("/{full_path:path}")
@@ -183,26 +187,14 @@ def initialize_mock_data():
 
 initialize_mock_data()
 
-def get_azure_client():
-    """Get Azure OpenAI client"""
-    return AzureOpenAI(
-        azure_endpoint=AZURE_ENDPOINT,
-        api_key=AZURE_API_KEY,
-        api_version=AZURE_API_VERSION
-    )
+@app.on_event("shutdown")
+async def stop_extraction_pool():
+    shutdown_extraction_pool()
 
-def extract_text_from_docx(file_content: bytes) -> str:
-    """Extract text from DOCX file"""
-    try:
-        if not DOCX_AVAILABLE:
-            return "DOCX parsing not available."
-        from io import BytesIO
-        doc = Document(BytesIO(file_content))
-        text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-        return text
-    except Exception as e:
-        print(f"Error extracting text from DOCX: {e}")
-        return ""
+@app.on_event("shutdown")
+async def shutdown_llm_client():
+    """Release the pooled LLM connections on shutdown"""
+    await close_async_client()
 
 def extract_text_from_image(file_content: bytes) -> str:
     """Extract text from image using OCR"""
@@ -218,7 +210,8 @@ def extract_text_from_image(file_content: bytes) -> str:
         print(f"Error in OCR: {e}")
         return ""
 
-def classify_form_type(text: str) -> str:
+@instrument_agent("Form Classifier")
+async def classify_form_type(text: str, use_cache: bool = True) -> str:
     """Classify form as Go or No-Go using LLM"""
     # First try keyword-based classification (fast fallback)
     text_upper = text.upper()
@@ -234,8 +227,6 @@ def classify_form_type(text: str) -> str:
     # Try LLM if API key is available
     if AZURE_API_KEY:
         try:
-            client = get_azure_client()
-            
             prompt = f"""You are analyzing a production line status form. Classify it as either "GO" or "NO-GO".
 
 Form Text:
@@ -246,17 +237,19 @@ A "NO-GO" form means the production line is down, has issues, or is not operatio
 
 Respond with ONLY one word: either "GO" or "NO-GO"."""
 
-            response = client.chat.completions.create(
-                model=AZURE_DEPLOYMENT,
+            completion = await chat_completion(
                 messages=[
                     {"role": "system", "content": "You are an expert in manufacturing production line analysis."},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.1,
-                max_tokens=10
+                max_tokens=10,
+                model=AZURE_DEPLOYMENT,
+                use_cache=use_cache,
+                priority=INTERACTIVE
             )
             
-            result = response.choices[0].message.content.strip().upper()
+            result = completion["content"].strip().upper()
             if "NO-GO" in result or "NOGO" in result or "DOWN" in result:
                 return "NO-GO"
             return "GO"
@@ -266,7 +259,8 @@ Respond with ONLY one word: either "GO" or "NO-GO"."""
     # Final fallback: default to GO if unclear
     return "GO"
 
-def extract_form_attributes(text: str) -> Dict:
+@instrument_agent("Attribute Extractor")
+async def extract_form_attributes(text: str, use_cache: bool = True) -> Dict:
     """Extract attributes from form text using LLM or regex fallback"""
     import re
     
@@ -316,8 +310,6 @@ def extract_form_attributes(text: str) -> Dict:
     # Try LLM extraction if API key is available (for better accuracy)
     if AZURE_API_KEY:
         try:
-            client = get_azure_client()
-            
             prompt = f"""Extract the following information from this production line form:
 
 Form Text:
@@ -335,24 +327,22 @@ Extract and return in JSON format:
 
 Only include fields that are clearly present in the form. Return valid JSON only."""
 
-            response = client.chat.completions.create(
-                model=AZURE_DEPLOYMENT,
+            completion = await chat_completion(
                 messages=[
                     {"role": "system", "content": "You are an expert in extracting structured data from forms."},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.1,
-                max_tokens=500
+                max_tokens=500,
+                model=AZURE_DEPLOYMENT,
+                use_cache=use_cache
             )
             
-            result_text = response.choices[0].message.content.strip()
-            # Clean JSON
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in result_text:
-                result_text = result_text.split("```")[1].split("```")[0].strip()
-            
-            llm_attributes = json.loads(result_text)
+            extracted = extract_json(completion["content"])
+            if not extracted.ok or not isinstance(extracted.value, dict):
+                record_parse_failure("attributes")
+                raise ValueError(f"Could not parse attributes JSON: {extracted.error or 'not a JSON object'}")
+            llm_attributes = extracted.value
             # Merge LLM results with regex results (LLM takes precedence)
             for key, value in llm_attributes.items():
                 if value is not None and value != []:
@@ -362,11 +352,10 @@ Only include fields that are clearly present in the form. Return valid JSON only
     
     return attributes
 
-def recommend_worker_reallocation(no_go_line_id: str, available_lines: List[str]) -> Dict:
+@instrument_agent("Worker Reallocation")
+async def recommend_worker_reallocation(no_go_line_id: str, available_lines: List[str], use_cache: bool = True) -> Dict:
     """Recommend worker reallocation using LLM/SLM"""
     try:
-        client = get_azure_client()
-        
         # Get workers from the down line
         down_line = production_lines.get(no_go_line_id, {})
         worker_ids = down_line.get("workers", [])
@@ -411,23 +400,22 @@ Return JSON format:
     "summary": "Overall reallocation strategy"
 }}"""
 
-        response = client.chat.completions.create(
-            model=AZURE_DEPLOYMENT,
+        completion = await chat_completion(
             messages=[
                 {"role": "system", "content": "You are an expert in manufacturing workforce optimization and production line management."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=2000
+            max_tokens=2000,
+            model=AZURE_DEPLOYMENT,
+            use_cache=use_cache
         )
         
-        result_text = response.choices[0].message.content.strip()
-        if "```json" in result_text:
-            result_text = result_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in result_text:
-            result_text = result_text.split("```")[1].split("```")[0].strip()
-        
-        return json.loads(result_text)
+        extracted = extract_json(completion["content"])
+        if not extracted.ok or not isinstance(extracted.value, dict):
+            record_parse_failure("reallocation")
+            raise ValueError(f"Could not parse reallocation JSON: {extracted.error or 'not a JSON object'}")
+        return extracted.value
     except Exception as e:
         print(f"Error in worker reallocation recommendation: {e}")
         # Fallback: simple distribution
@@ -449,7 +437,8 @@ Return JSON format:
 @app.post("/upload-form")
 async def upload_form(
     file: UploadFile = File(...),
-    form_type: str = Query("online", description="Form type: 'online' or 'offline'")
+    form_type: str = Query("online", description="Form type: 'online' or 'offline'"),
+    use_cache: bool = Query(True, description="Set to false to bypass the LLM response cache")
 ):
     """Upload production line status form (online or offline/handwritten)"""
     print(f"Received upload request: {file.filename}, type: {form_type}")
@@ -467,10 +456,11 @@ async def upload_form(
         
         # Extract text
         try:
+            # Off the event loop: OCR shells out to tesseract, DOCX parsing goes to the extraction pool
             if is_image:
-                text = extract_text_from_image(content)
+                text = await asyncio.to_thread(extract_text_from_image, content)
             else:
-                text = extract_text_from_docx(content)
+                text = await run_extraction(extract_docx_text, content)
             
             if not text or len(text.strip()) == 0:
                 text = f"Form uploaded: {file.filename}\nType: {'Handwritten' if is_image else 'Digital'}\nStatus: Processing..."
@@ -480,14 +470,14 @@ async def upload_form(
         
         # Classify form
         try:
-            form_classification = classify_form_type(text)
+            form_classification = await classify_form_type(text, use_cache=use_cache)
         except Exception as e:
             print(f"Error classifying form: {e}")
             form_classification = "GO"  # Default fallback
         
         # Extract attributes
         try:
-            attributes = extract_form_attributes(text)
+            attributes = await extract_form_attributes(text, use_cache=use_cache)
         except Exception as e:
             print(f"Error extracting attributes: {e}")
             attributes = {
@@ -526,7 +516,7 @@ async def upload_form(
                 
                 if available_lines:
                     try:
-                        recommendations = recommend_worker_reallocation(pl_id, available_lines[:10])  # Limit to 10 lines
+                        recommendations = await recommend_worker_reallocation(pl_id, available_lines[:10], use_cache=use_cache)  # Limit to 10 lines
                         form_data["reallocation_recommendations"] = recommendations
                     except Exception as e:
                         print(f"Error generating reallocation recommendations: {e}")
@@ -629,37 +619,89 @@ class ChatRequest(BaseModel):
     context: Optional[Dict] = None
     chat_history: List = []
 
-@app.post("/chat")
-async def chat_endpoint(request: ChatRequest):
-    """AI Chat endpoint with RAG for manufacturing context"""
-    try:
-        client = get_azure_client()
-        
-        # Build knowledge base from current state
-        kb_parts = []
-        
-        # Production lines status
-        running_count = sum(1 for pl in production_lines.values() if pl["status"] == "running")
-        down_count = sum(1 for pl in production_lines.values() if pl["status"] == "down")
-        kb_parts.append(f"=== PRODUCTION LINES STATUS ===\nTotal: 100\nRunning: {running_count}\nDown: {down_count}\n")
-        
-        # Recent forms
-        if uploaded_forms:
-            recent = list(uploaded_forms.values())[-5:]
-            kb_parts.append(f"=== RECENT FORMS ===\n{json.dumps(recent, indent=2)}\n")
-        
-        # Workers info
-        kb_parts.append(f"=== WORKERS ===\nTotal: {len(workers)}\nActive: {sum(1 for w in workers.values() if w['status'] == 'active')}\n")
-        
-        # Processing results
-        if form_processing_results:
-            no_go_results = [r for r in form_processing_results.values() if r.get("classification") == "NO-GO"]
-            if no_go_results:
-                kb_parts.append(f"=== NO-GO FORMS ===\n{json.dumps(no_go_results, indent=2)}\n")
-        
-        knowledge_base = "\n".join(kb_parts)
-        
-        system_message = f"""You are an AI assistant for Pepsico Manufacturing Production Line Management System.
+# Chat answers start with one of these (anything else longer than 10 characters becomes a bullet)
+CHAT_BULLET_PREFIXES = ('-', '*', '•', '1.', '2.', '3.', '4.', '5.')
+
+class BulletFormatter:
+    """Rewrites chat answer lines as bullet points, incrementally as the text streams in
+
+    Each line is stripped, and a line of more than 10 characters that does not
+    start with a bullet gets "- ". A line is passed on as soon as its bullet is
+    decided (after its first 11 characters, or at its end), so feeding the
+    answer in deltas produces the same text as formatting it at once.
+    """
+
+    def __init__(self):
+        self.line = ""          # start of the current line, while its bullet is undecided
+        self.decided = False
+        self.whitespace = ""    # whitespace held back until something follows it on the line
+
+    def _decide(self, at_end: bool) -> str:
+        line = self.line.rstrip()
+        if not at_end and len(line) <= 10:
+            return ""
+        self.decided = True
+        self.whitespace = self.line[len(line):]
+        self.line = ""
+        if len(line) > 10 and not line.startswith(CHAT_BULLET_PREFIXES):
+            return f"- {line}"
+        return line
+
+    def feed(self, delta: str) -> str:
+        """Formatted text that can be sent for this delta"""
+        output = []
+        for char in delta:
+            if char == "\n":
+                if not self.decided:
+                    output.append(self._decide(at_end=True))
+                output.append("\n")
+                self.line, self.decided, self.whitespace = "", False, ""
+            elif not self.decided:
+                if self.line or not char.isspace():
+                    self.line += char
+                    output.append(self._decide(at_end=False))
+            elif char.isspace():
+                self.whitespace += char
+            else:
+                output.append(self.whitespace + char)
+                self.whitespace = ""
+        return "".join(output)
+
+    def finish(self) -> str:
+        """The rest of the last line"""
+        return "" if self.decided else self._decide(at_end=True)
+
+def format_chat_bullets(text: str) -> str:
+    formatter = BulletFormatter()
+    return formatter.feed(text) + formatter.finish()
+
+def build_chat_messages(message: str, chat_history: list) -> list:
+    """Chat completion messages with a knowledge base built from the current state"""
+    # Build knowledge base from current state
+    kb_parts = []
+    
+    # Production lines status
+    running_count = sum(1 for pl in production_lines.values() if pl["status"] == "running")
+    down_count = sum(1 for pl in production_lines.values() if pl["status"] == "down")
+    kb_parts.append(f"=== PRODUCTION LINES STATUS ===\nTotal: 100\nRunning: {running_count}\nDown: {down_count}\n")
+    
+    # Recent forms
+    if uploaded_forms:
+        recent = list(uploaded_forms.values())[-5:]
+        kb_parts.append(f"=== RECENT FORMS ===\n{json.dumps(recent, indent=2)}\n")
+    
+    # Workers info
+    kb_parts.append(f"=== WORKERS ===\nTotal: {len(workers)}\nActive: {sum(1 for w in workers.values() if w['status'] == 'active')}\n")
+    
+    # Processing results
+    if form_processing_results:
+        no_go_results = [r for r in form_processing_results.values() if r.get("classification") == "NO-GO"]
+        if no_go_results:
+            kb_parts.append(f"=== NO-GO FORMS ===\n{json.dumps(no_go_results, indent=2)}\n")
+    
+    knowledge_base = "\n".join(kb_parts)
+    
+    system_message = f"""You are an AI assistant for Pepsico Manufacturing Production Line Management System.
 
 KNOWLEDGE BASE:
 {knowledge_base}
@@ -685,49 +727,94 @@ Example format:
 
 Answer questions based on the knowledge base. Always use bullet points, never paragraphs."""
 
-        messages = [{"role": "system", "content": system_message}]
-        
-        # Add chat history
-        for msg in request.chat_history[-5:]:
-            messages.append({"role": msg.get("role", "user"), "content": msg.get("content", "")})
-        
-        messages.append({"role": "user", "content": request.message})
+    messages = [{"role": "system", "content": system_message}]
+    
+    # Add chat history
+    for msg in chat_history[-5:]:
+        messages.append({"role": msg.get("role", "user"), "content": msg.get("content", "")})
+    
+    messages.append({"role": "user", "content": message})
+    return messages
+
+@app.post("/chat")
+@instrument_agent("Chat")
+async def chat_endpoint(request: ChatRequest):
+    """AI Chat endpoint with RAG for manufacturing context"""
+    try:
+        messages = build_chat_messages(request.message, request.chat_history)
         
-        response = client.chat.completions.create(
-            model=AZURE_DEPLOYMENT,
+        completion = await chat_completion(
             messages=messages,
             temperature=0.3,
-            max_tokens=500
+            max_tokens=500,
+            model=AZURE_DEPLOYMENT,
+            use_cache=False,
+            priority=INTERACTIVE
         )
         
         # Format response to ensure bullet points
-        response_text = response.choices[0].message.content
-        
-        # If response doesn't start with bullet points, convert to bullet points
-        lines = response_text.split('\n')
-        formatted_lines = []
-        for line in lines:
-            line = line.strip()
-            if line:
-                # If line doesn't already start with bullet, add one
-                if not line.startswith(('-', '*', '•', '1.', '2.', '3.', '4.', '5.')):
-                    # Check if it's a sentence that should be a bullet point
-                    if len(line) > 10:  # Only convert longer lines
-                        formatted_lines.append(f"- {line}")
-                    else:
-                        formatted_lines.append(line)
-                else:
-                    formatted_lines.append(line)
-            else:
-                formatted_lines.append('')
-        
-        response_text = '\n'.join(formatted_lines)
-        
-        return {"response": response_text}
+        return {"response": format_chat_bullets(completion["content"])}
     except Exception as e:
         print(f"Chat error: {e}")
+        record_agent_error(e)
         return {"response": f"Error: {str(e)}"}
 
+def format_sse_event(event: str, data: dict) -> str:
+    """Format a Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """/chat with the answer streamed as Server-Sent Events
+
+    Events: token (bullet-formatted text, sent line by line as soon as each
+    line's bullet is decided), then done (the full formatted response) or error.
+    """
+    async def event_stream():
+        with agent_span("Chat"):
+            try:
+                messages = build_chat_messages(request.message, request.chat_history)
+                formatter = BulletFormatter()
+                parts = []
+                async for event, data in stream_chat_completion(messages, temperature=0.3, max_tokens=500, model=AZURE_DEPLOYMENT, use_cache=False, priority=INTERACTIVE):
+                    text = formatter.feed(data) if event == "token" else formatter.finish()
+                    if text:
+                        parts.append(text)
+                        yield format_sse_event("token", {"delta": text})
+                    if event == "completion":
+                        yield format_sse_event("done", {"response": "".join(parts), "finish_reason": data["finish_reason"]})
+            except Exception as e:
+                print(f"Chat error: {e}")
+                record_agent_error(e)
+                yield format_sse_event("error", {"detail": str(e)})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: HTTP, agent and LLM latency, token usage, finish reasons, retries, queue depth and parse failures"""
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Get LLM response cache statistics"""
+    return await asyncio.to_thread(get_llm_cache().stats)
+
+@app.get("/llm/governor")
+async def get_governor_stats():
+    """LLM rate limit budgets, queued calls per priority and any Retry-After pause"""
+    return get_llm_governor().stats()
+
+@app.delete("/cache")
+async def clear_cache():
+    """Clear the LLM response cache"""
+    removed = await asyncio.to_thread(get_llm_cache().clear)
+    return {"success": True, "removed": removed}
+
 @app.get("/")
 async def root():
     return {
@@ -741,6 +828,9 @@ async def root():
             "workers": "/workers",
             "forms": "/forms",
             "chat": "/chat",
+            "cache_stats": "/cache/stats",
+            "llm_governor": "/llm/governor",
+            "metrics": "/metrics",
             "health": "/health"
         }
     }
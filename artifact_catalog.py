@@ -0,0 +1,264 @@
+"""
+Catalog of the artifacts in the Output directory
+
+Every output file is indexed in SQLite with its document (file stem), stage,
+pipeline run ID, SHA-256, size and timestamps. Writers record a file right
+after saving it, and the Output tree is synced on startup so that files written
+by older versions or by hand are indexed too (unchanged files are recognised by
+size and modification time, without hashing them again).
+
+Each change to an artifact's content is a new version. Files are overwritten
+in place, so only the latest version is on disk; earlier versions remain as
+catalog history. The latest version of each (document, stage) is kept in its
+own table, so looking it up is a single primary key probe.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+ARTIFACT_CATALOG_PATH = Path(os.getenv("ARTIFACT_CATALOG_PATH", str(Path(__file__).parent / ".cache" / "catalog.db")))
+
+# Pipeline run the current task is writing artifacts for
+current_run_id: ContextVar = ContextVar("current_run_id", default=None)
+
+# Output file locations (relative to the Output directory) -> stage
+ARTIFACT_PATTERNS = [
+    (re.compile(r"^UserStory/(?P<document>.+)_userstory\.docx$"), "user_story_docx"),
+    (re.compile(r"^UserStory/(?P<document>.+)_userstory\.json$"), "user_story_json"),
+    (re.compile(r"^TestCases/(?P<document>.+)_testcases\.json$"), "test_cases_json"),
+    (re.compile(r"^TestData/(?P<document>.+)_testdata\.json$"), "test_data_json"),
+    (re.compile(r"^TestCoverage/(?P<document>.+)_testcoverage\.json$"), "test_coverage_json"),
+    (re.compile(r"^Excel/(?P<document>.+)_TestCases_TestData\.xlsx$"), "excel"),
+    (re.compile(r"^SeleniumScripts/(?P<document>.+)_test\.py$"), "selenium_script"),
+    # Misnamed outputs of earlier versions
+    (re.compile(r"^TestDATF/(?P<document>.+)_testdATF\.json$"), "test_data_json_legacy"),
+    (re.compile(r"^Excel/(?P<document>.+)_TestCases_TestDATF\.xlsx$"), "excel_legacy")
+]
+
+def classify(relative_path: str) -> tuple:
+    """(document, stage) of an Output file
+
+    Unrecognised files are stage "other" with their relative path as document,
+    so files sharing a stem (in other folders or with other extensions) stay apart.
+    """
+    for pattern, stage in ARTIFACT_PATTERNS:
+        match = pattern.match(relative_path)
+        if match:
+            return match.group("document"), stage
+    return relative_path, "other"
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+_COLUMNS = "id, path, document, stage, version, run_id, sha256, size, mtime_ns, created_at"
+_CATALOG_COLUMNS = ", ".join("c." + column for column in _COLUMNS.split(", "))
+
+def _row_to_entry(row) -> Optional[dict]:
+    if row is None:
+        return None
+    artifact_id, path, document, stage, version, run_id, sha256, size, mtime_ns, created_at = row
+    return {
+        "id": artifact_id,
+        "path": path,
+        "document": document,
+        "stage": stage,
+        "version": version,
+        "run_id": run_id,
+        "sha256": sha256,
+        "size": size,
+        "modified_at": datetime.fromtimestamp(mtime_ns / 1e9).isoformat(),
+        "created_at": datetime.fromtimestamp(created_at).isoformat()
+    }
+
+class ArtifactCatalog:
+    """SQLite index of the files under an output directory"""
+
+    def __init__(self, db_path: Path, root: Path):
+        self.db_path = Path(db_path)
+        self.root = Path(root)
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS catalog (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    path TEXT NOT NULL,
+                    document TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    run_id TEXT,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_catalog_document_stage ON catalog(document, stage, version)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_catalog_run ON catalog(run_id)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS latest (
+                    document TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    artifact_id INTEGER NOT NULL,
+                    PRIMARY KEY (document, stage)
+                ) WITHOUT ROWID"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        """Connection for one operation: committed (or rolled back) and closed on exit"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _relative(self, path: Path) -> str:
+        return Path(os.path.relpath(Path(path).resolve(), self.root.resolve())).as_posix()
+
+    def _latest(self, conn, document: str, stage: str):
+        return conn.execute(
+            f"SELECT {_CATALOG_COLUMNS} FROM latest l "
+            "JOIN catalog c ON c.id = l.artifact_id WHERE l.document = ? AND l.stage = ?",
+            (document, stage)
+        ).fetchone()
+
+    def record(self, path: Path, stage: str = None, document: str = None, run_id: str = None) -> dict:
+        """Index a file that has just been written and return its catalog entry
+
+        stage and document default to what the file's location implies. A new
+        version is only added when the content differs from the latest one.
+        """
+        path = Path(path)
+        relative = self._relative(path)
+        if stage is None or document is None:
+            default_document, default_stage = classify(relative)
+            document = document or default_document
+            stage = stage or default_stage
+        if run_id is None:
+            run_id = current_run_id.get()
+        stat = path.stat()
+        sha256 = file_sha256(path)
+        with self._lock, self._connect() as conn:
+            latest = self._latest(conn, document, stage)
+            if latest is not None and latest[6] == sha256 and latest[1] == relative:
+                # Same content rewritten - keep the version, note the new write
+                conn.execute(
+                    "UPDATE catalog SET mtime_ns = ?, run_id = COALESCE(?, run_id) WHERE id = ?",
+                    (stat.st_mtime_ns, run_id, latest[0])
+                )
+                artifact_id = latest[0]
+            else:
+                version = (latest[4] if latest is not None else 0) + 1
+                artifact_id = conn.execute(
+                    f"INSERT INTO catalog ({_COLUMNS}) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (relative, document, stage, version, run_id, sha256, stat.st_size, stat.st_mtime_ns, time.time())
+                ).lastrowid
+                conn.execute(
+                    "INSERT INTO latest (document, stage, artifact_id) VALUES (?, ?, ?) "
+                    "ON CONFLICT (document, stage) DO UPDATE SET artifact_id = excluded.artifact_id",
+                    (document, stage, artifact_id)
+                )
+            row = conn.execute(f"SELECT {_COLUMNS} FROM catalog WHERE id = ?", (artifact_id,)).fetchone()
+        return _row_to_entry(row)
+
+    def sync(self) -> dict:
+        """Index new or changed files under the root and drop deleted ones from the latest table"""
+        with self._lock, self._connect() as conn:
+            indexed = {
+                (document, stage): (path, size, mtime_ns)
+                for document, stage, path, size, mtime_ns in conn.execute(
+                    "SELECT l.document, l.stage, c.path, c.size, c.mtime_ns FROM latest l JOIN catalog c ON c.id = l.artifact_id"
+                )
+            }
+        recorded = 0
+        seen = set()
+        for path in sorted(self.root.rglob("*")):
+            if not path.is_file() or path.name.startswith("."):
+                continue
+            relative = self._relative(path)
+            document, stage = classify(relative)
+            seen.add((document, stage))
+            stat = path.stat()
+            if indexed.get((document, stage)) == (relative, stat.st_size, stat.st_mtime_ns):
+                continue
+            self.record(path, stage, document)
+            recorded += 1
+        # Files that are gone, and rows keyed differently than their file is now classified
+        removed = [
+            key for key in indexed
+            if key not in seen and (not (self.root / indexed[key][0]).exists() or classify(indexed[key][0]) != key)
+        ]
+        if removed:
+            with self._lock, self._connect() as conn:
+                conn.executemany("DELETE FROM latest WHERE document = ? AND stage = ?", removed)
+        return {"indexed": len(seen), "recorded": recorded, "removed": len(removed)}
+
+    def latest(self, document: str, stage: str) -> Optional[dict]:
+        """Latest version of an artifact"""
+        with self._lock, self._connect() as conn:
+            return _row_to_entry(self._latest(conn, document, stage))
+
+    def latest_for_document(self, document: str) -> Dict[str, dict]:
+        """Latest version of each of a document's artifacts, by stage"""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {_CATALOG_COLUMNS} FROM latest l "
+                "JOIN catalog c ON c.id = l.artifact_id WHERE l.document = ? ORDER BY l.stage",
+                (document,)
+            ).fetchall()
+        return {entry["stage"]: entry for entry in map(_row_to_entry, rows)}
+
+    def get(self, artifact_id: int) -> Optional[dict]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(f"SELECT {_COLUMNS} FROM catalog WHERE id = ?", (artifact_id,)).fetchone()
+        return _row_to_entry(row)
+
+    def search(self, document: str = None, stage: str = None, run_id: str = None, query: str = None,
+               latest_only: bool = True, page: int = 1, page_size: int = 50) -> dict:
+        """Page through catalog entries, newest first
+
+        query matches a substring of the document name or path. With
+        latest_only, only the current version of each artifact is listed.
+        """
+        source = "latest l JOIN catalog c ON c.id = l.artifact_id" if latest_only else "catalog c"
+        conditions = []
+        params = []
+        for column, value in (("c.document", document), ("c.stage", stage), ("c.run_id", run_id)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if query:
+            conditions.append("(c.document LIKE ? ESCAPE '\\' OR c.path LIKE ? ESCAPE '\\')")
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            params.extend([pattern, pattern])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        page = max(page, 1)
+        page_size = min(max(page_size, 1), 500)
+        with self._lock, self._connect() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM {source}{where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {_CATALOG_COLUMNS} FROM {source}{where} ORDER BY c.mtime_ns DESC, c.id DESC LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size]
+            ).fetchall()
+        return {
+            "items": [_row_to_entry(row) for row in rows],
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "pages": (total + page_size - 1) // page_size
+        }
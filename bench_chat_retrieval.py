@@ -0,0 +1,88 @@
+"""
+Benchmark for the chat retrieval index against the previous full knowledge base
+
+Loads the saved user stories, test cases and Test Data of each document in the
+Output directory and, for a set of typical questions, compares the knowledge
+base tokens of the previous prompt (every result with json.dumps(indent=2))
+with the retrieved context, and times building the index and answering a
+retrieval query.
+
+Usage: python bench_chat_retrieval.py [question ...]
+"""
+import json
+import sys
+import time
+from pathlib import Path
+
+from chat_retrieval import KnowledgeIndex
+from prompt_projection import estimate_tokens
+
+OUTPUT_DIR = Path(__file__).parent / "Output"
+
+QUESTIONS = [
+    "What is this document about?",
+    "Which test cases cover login with an invalid password?",
+    "Show the test data for TC-003",
+    "What are the acceptance criteria of US-002?",
+    "Which high priority test cases are there for payments?",
+    "List the non functional requirements"
+]
+
+def load_json(path: Path):
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+def load_documents() -> dict:
+    """document -> agent results, for documents with saved user stories and test cases"""
+    documents = {}
+    for story_file in sorted((OUTPUT_DIR / "UserStory").glob("*_userstory.json")):
+        document = story_file.name[:-len("_userstory.json")]
+        test_cases = load_json(OUTPUT_DIR / "TestCases" / f"{document}_testcases.json")
+        if test_cases is None:
+            continue
+        results = {"2_user_story_creator": load_json(story_file), "3_test_case_generator": test_cases}
+        test_data = load_json(OUTPUT_DIR / "TestData" / f"{document}_testdata.json")
+        if test_data is not None:
+            results["4_test_data_generator"] = test_data
+        documents[document] = results
+    return documents
+
+def legacy_knowledge_base(file_name: str, agent_results: dict) -> str:
+    """The knowledge base previously built for every chat message"""
+    sections = [f"=== UPLOADED FILE ===\nFile: {file_name}\n"]
+    titles = {"1_requirements_analyst": "REQUIREMENTS ANALYSIS", "2_user_story_creator": "USER STORIES",
+              "3_test_case_generator": "TEST CASES", "4_test_data_generator": "Test Data"}
+    for stage, title in titles.items():
+        if agent_results.get(stage):
+            sections.append(f"=== {title} ===\n{json.dumps(agent_results[stage], indent=2)}\n")
+    return "\n".join(sections)
+
+def main():
+    questions = sys.argv[1:] or QUESTIONS
+    documents = load_documents()
+    if not documents:
+        raise SystemExit(f"No saved user stories and test cases found in {OUTPUT_DIR}")
+    print(f"{'document':<42}{'items':>7}{'build ms':>10}{'query ms':>10}{'full tokens':>13}{'retrieved':>11}{'reduction':>11}")
+    totals = [0, 0]
+    for document, results in documents.items():
+        legacy_tokens = estimate_tokens(legacy_knowledge_base(f"{document}.docx", results))
+        started = time.perf_counter()
+        index = KnowledgeIndex(f"{document}.docx", results)
+        build_ms = (time.perf_counter() - started) * 1000
+        retrieved_tokens = []
+        started = time.perf_counter()
+        for question in questions:
+            retrieved_tokens.append(estimate_tokens(index.render(index.retrieve(question))))
+        query_ms = (time.perf_counter() - started) * 1000 / len(questions)
+        average = sum(retrieved_tokens) / len(retrieved_tokens)
+        totals[0] += legacy_tokens
+        totals[1] += average
+        print(f"{document[:41]:<42}{len(index.items):>7}{build_ms:>10.1f}{query_ms:>10.2f}"
+              f"{legacy_tokens:>13}{average:>11.0f}{legacy_tokens / max(average, 1):>10.1f}x")
+    print(f"\nAverage knowledge base per chat message: {totals[0] / len(documents):.0f} -> "
+          f"{totals[1] / len(documents):.0f} tokens ({totals[0] / max(totals[1], 1):.1f}x fewer)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark for docx_extract against python-docx
+
+Times text extraction and measures peak Python memory for the documents in
+SampleInputs/ and "sample input.docx", plus a generated document with
+paragraphs and tables (requirements-matrix style) of the given size.
+
+Usage: python bench_docx_extract.py [iterations] [synthetic_sections]
+"""
+import io
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from docx import Document
+
+from docx_extract import extract_docx_text, iter_docx_blocks
+
+BASE_DIR = Path(__file__).parent
+
+def python_docx_paragraphs(content: bytes) -> str:
+    """The previous extract_text_from_docx: paragraphs only"""
+    doc = Document(io.BytesIO(content))
+    return "\n".join(paragraph.text for paragraph in doc.paragraphs)
+
+def python_docx_with_tables(content: bytes) -> str:
+    """python-docx reading paragraphs and table cells, for a like-for-like comparison"""
+    doc = Document(io.BytesIO(content))
+    lines = [paragraph.text for paragraph in doc.paragraphs]
+    for table in doc.tables:
+        for row in table.rows:
+            lines.append(" | ".join(cell.text for cell in row.cells))
+    return "\n".join(lines)
+
+def build_synthetic(sections: int) -> bytes:
+    doc = Document()
+    doc.add_heading("Synthetic Requirements", 0)
+    for section in range(1, sections + 1):
+        doc.add_heading(f"{section}. Feature {section}", level=1)
+        for line in range(5):
+            doc.add_paragraph(f"The system shall support capability {section}.{line} with validation and audit logging.")
+        table = doc.add_table(rows=1, cols=4)
+        for cell, header in zip(table.rows[0].cells, ["ID", "Requirement", "Priority", "Acceptance"]):
+            cell.text = header
+        for row in range(8):
+            cells = table.add_row().cells
+            cells[0].text = f"REQ-{section:03d}-{row}"
+            cells[1].text = f"Requirement {row} of feature {section} must be traceable to a test case"
+            cells[2].text = "High" if row % 2 else "Medium"
+            cells[3].text = "Verified by automated regression"
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def measure(extractor, content: bytes, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        text = extractor(content)
+    elapsed = (time.perf_counter() - start) / iterations
+    tracemalloc.start()
+    extractor(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, text
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sections = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    documents = [(path.name, path.read_bytes()) for path in sorted((BASE_DIR / "SampleInputs").glob("*.docx"))]
+    sample = BASE_DIR / "sample input.docx"
+    if sample.exists():
+        documents.append((sample.name, sample.read_bytes()))
+    documents.append((f"synthetic ({sections} sections)", build_synthetic(sections)))
+
+    extractors = [
+        ("python-docx", python_docx_paragraphs),
+        ("python-docx+tables", python_docx_with_tables),
+        ("docx_extract", extract_docx_text)
+    ]
+    print(f"{'document':<44}{'extractor':<20}{'ms':>9}{'peak KiB':>10}{'chars':>9}")
+    for name, content in documents:
+        times = {}
+        for label, extractor in extractors:
+            runs = max(1, iterations // 10) if name.startswith("synthetic") else iterations
+            elapsed, peak, text = measure(extractor, content, runs)
+            times[label] = elapsed
+            print(f"{name[:43]:<44}{label:<20}{elapsed * 1000:>9.2f}{peak / 1024:>10.0f}{len(text):>9}")
+        rows = sum(1 for block in iter_docx_blocks(content) if block.kind == "table_row")
+        headings = sum(1 for block in iter_docx_blocks(content) if block.kind == "heading")
+        print(
+            f"{'':<44}docx_extract {times['python-docx'] / elapsed:.1f}x / {times['python-docx+tables'] / elapsed:.1f}x faster, "
+            f"{headings} headings, {rows} table rows\n"
+        )
+
+if __name__ == "__main__":
+    main()
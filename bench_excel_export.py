@@ -0,0 +1,176 @@
+"""
+Benchmark for excel_export against the previous in-memory Excel export
+
+Generates test cases and Test Data sets of the given sizes and times both
+exports. Each export runs in a fresh process so its peak RSS is reported on
+its own. Before timing, both exports are run on a small data set and their
+cell values and column widths are compared.
+
+Usage: python bench_excel_export.py [rows ...]   (default: 10000 100000)
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font, PatternFill, Alignment
+
+from excel_export import TEST_DATA_STANDARD_FIELDS, test_case_row, test_data_values, write_test_workbook
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DATA_FIELDS = ["SKU_ID", "Product_Name", "Price", "Quantity", "Customer_Email", "Shipping_Address", "Coupon_Code", "Payment_Method"]
+
+def build_items(rows: int):
+    """rows Test Data sets for rows / 2 test cases, with a few optional fields per set"""
+    test_cases = []
+    for index in range(1, rows // 2 + 1):
+        test_cases.append({
+            "id": f"TC-{index:05d}",
+            "title": f"Verify order placement scenario {index}",
+            "description": "Validate that an order can be placed with a valid cart and payment details",
+            "preconditions": ["User is logged in", "Cart contains at least one product"],
+            "test_steps": ["Open the cart", "Click checkout", "Enter payment details", "Confirm the order"],
+            "expected_results": "Order is created and a confirmation number is shown",
+            "priority": "High" if index % 3 else "Medium",
+            "test_type": "Functional",
+            "user_story_id": f"US-{index % 40 + 1:03d}"
+        })
+    test_data = []
+    for index in range(1, rows + 1):
+        td = {
+            "id": f"TD-{index:06d}",
+            "test_case_id": f"TC-{(index + 1) // 2:05d}",
+            "data_set_name": "Positive" if index % 2 else "Boundary",
+            "description": f"Data set {index} for checkout validation"
+        }
+        for position, field in enumerate(DATA_FIELDS):
+            if (index + position) % 5:
+                td[field] = f"{field.lower()}-{index}-{'x' * (index % 17)}"
+        if index % 50 == 0:
+            td["Line_Items"] = [{"sku": "S1", "qty": 2}, {"sku": "S2", "qty": 1}]
+        test_data.append(td)
+    return test_cases, test_data
+
+def legacy_export(excel_file: Path, test_cases_list: list, test_data_list: list):
+    """The previous export_to_excel: in-memory workbook, second pass for widths, separate field scan"""
+    wb = Workbook()
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    header_font = Font(bold=True, color="FFFFFF")
+
+    def style_and_size(ws):
+        for cell in ws[1]:
+            cell.fill = header_fill
+            cell.font = header_font
+            cell.alignment = Alignment(horizontal="center", vertical="center")
+        for column in ws.columns:
+            max_length = 0
+            for cell in column:
+                if len(str(cell.value)) > max_length:
+                    max_length = len(str(cell.value))
+            ws.column_dimensions[column[0].column_letter].width = min(max_length + 2, 50)
+
+    ws = wb.active
+    ws.title = "Test Cases"
+    ws.append(["Test Case ID", "Test Case Name", "Description", "Preconditions", "Test Steps", "Expected Result", "Priority", "Status"])
+    for index, tc in enumerate(test_cases_list, start=1):
+        ws.append(test_case_row(tc, index))
+    style_and_size(ws)
+
+    ws = wb.create_sheet("Test Data")
+    all_data_fields = set()
+    for td in test_data_list:
+        all_data_fields.update(k for k in td if k not in TEST_DATA_STANDARD_FIELDS)
+        for key in ("data", "data_values"):
+            if isinstance(td.get(key), dict):
+                all_data_fields.update(td[key].keys())
+    fields = sorted(all_data_fields)
+    ws.append(["Test Data ID", "Test Case ID", "Data Set Name", "Description"] + (fields or ["Test Data Values"]))
+    for index, td in enumerate(test_data_list, start=1):
+        row = [td.get("test_data_id") or td.get("id", f"TD_{index}"), td.get("test_case_id", ""),
+               td.get("data_set_name") or td.get("name", ""), td.get("description", "")]
+        values = test_data_values(td)
+        if isinstance(values, dict):
+            row.extend(values.get(field, "") for field in fields)
+        else:
+            row.append(values)
+        ws.append(row)
+    style_and_size(ws)
+    wb.save(excel_file)
+
+EXPORTS = {"legacy": legacy_export, "streaming": write_test_workbook}
+
+def peak_rss_mib() -> float:
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_one(name: str, rows: int) -> dict:
+    test_cases, test_data = build_items(rows)
+    baseline = peak_rss_mib()
+    with tempfile.TemporaryDirectory() as directory:
+        excel_file = Path(directory) / "bench.xlsx"
+        start = time.perf_counter()
+        EXPORTS[name](excel_file, test_cases, test_data)
+        elapsed = time.perf_counter() - start
+        size = excel_file.stat().st_size
+    return {"seconds": elapsed, "peak_rss_mib": peak_rss_mib(), "input_rss_mib": baseline, "bytes": size}
+
+def sheet_snapshot(excel_file: Path) -> dict:
+    wb = load_workbook(excel_file)
+    return {
+        ws.title: {
+            "values": [list(row) for row in ws.iter_rows(values_only=True)],
+            "widths": {letter: dim.width for letter, dim in ws.column_dimensions.items() if dim.width}
+        }
+        for ws in wb.worksheets
+    }
+
+def check_equivalent():
+    test_cases, test_data = build_items(400)
+    test_data.append({"id": "TD-OLD", "test_case_id": "TC-00001", "data": {"Legacy_Field": "nested value"}})
+    test_data.append({"id": "TD-LIST", "test_case_id": "TC-00001", "data_values": ["a", "b"]})
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_file = Path(directory) / "legacy.xlsx"
+        streaming_file = Path(directory) / "streaming.xlsx"
+        legacy_export(legacy_file, test_cases, test_data)
+        write_test_workbook(streaming_file, test_cases, test_data)
+        if sheet_snapshot(legacy_file) != sheet_snapshot(streaming_file):
+            raise SystemExit("Streaming export differs from the legacy export")
+    print("Streaming export matches the legacy export (values and column widths)\n")
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--run":
+        print(json.dumps(run_one(sys.argv[2], int(sys.argv[3]))))
+        return
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    check_equivalent()
+    print(f"{'rows':>8}{'export':>11}{'seconds':>10}{'peak RSS MiB':>14}{'export MiB':>12}{'file KiB':>10}")
+    for rows in sizes:
+        results = {}
+        for name in EXPORTS:
+            output = subprocess.run(
+                [sys.executable, __file__, "--run", name, str(rows)],
+                check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+            ).stdout
+            result = results[name] = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{rows:>8}{name:>11}{result['seconds']:>10.2f}{result['peak_rss_mib']:>14.0f}"
+                f"{result['peak_rss_mib'] - result['input_rss_mib']:>12.0f}{result['bytes'] / 1024:>10.0f}"
+            )
+        legacy, streaming = results["legacy"], results["streaming"]
+        print(f"{'':>8}streaming is {legacy['seconds'] / streaming['seconds']:.1f}x faster, "
+              f"{legacy['peak_rss_mib'] - legacy['input_rss_mib']:.0f} -> "
+              f"{streaming['peak_rss_mib'] - streaming['input_rss_mib']:.0f} MiB above the input data\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Micro-benchmark for json_extract against the legacy fence-splitting parser
+
+Builds LLM-style responses from the saved outputs in Output/TestCases and
+Output/TestData (plain JSON, fenced JSON with prose, double-encoded JSON and any
+stored raw_response fields) and times both parsers over them.
+
+Usage: python bench_json_extract.py [iterations]
+"""
+import contextlib
+import io
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+from json_extract import extract_json, parse_agent_response
+from json_stream import JSONItemStream
+
+BASE_DIR = Path(__file__).parent
+SOURCE_DIRS = [BASE_DIR / "Output" / "TestCases", BASE_DIR / "Output" / "TestData"]
+
+def legacy_extract(text):
+    """The split-on-fences logic previously copied through app.py"""
+    if isinstance(text, str) and text.strip().startswith('"'):
+        try:
+            decoded = json.loads(text)
+            if isinstance(decoded, str):
+                text = decoded
+        except json.JSONDecodeError:
+            pass
+    cleaned_text = text.strip()
+    if "```json" in cleaned_text:
+        cleaned_text = cleaned_text.split("```json")[1].split("```")[0].strip()
+    elif "```" in cleaned_text:
+        cleaned_text = cleaned_text.split("```")[1].split("```")[0].strip()
+    try:
+        return json.loads(cleaned_text)
+    except json.JSONDecodeError:
+        return None
+
+def parse_with_extract_json(text):
+    result = extract_json(text)
+    return result.value if result.ok else None
+
+def build_cases():
+    cases = []
+    for source_dir in SOURCE_DIRS:
+        for path in sorted(source_dir.glob("*.json")):
+            data = json.loads(path.read_text(encoding="utf-8"))
+            raw = data.pop("raw_response", None)
+            body = json.dumps(data, indent=2)
+            fenced = f"Here is the output you asked for:\n```json\n{body}\n```\nLet me know if you need more."
+            cases.append((path.name, "plain", body))
+            cases.append((path.name, "fenced", fenced))
+            cases.append((path.name, "double_encoded", json.dumps(fenced)))
+            if isinstance(raw, str) and raw:
+                cases.append((path.name, "raw_response", raw))
+    return cases
+
+def time_parser(parser, cases, iterations):
+    start = time.perf_counter()
+    parsed = 0
+    for _ in range(iterations):
+        parsed = 0
+        for _, _, text in cases:
+            if parser(text) is not None:
+                parsed += 1
+    return (time.perf_counter() - start) / iterations, parsed
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    cases = build_cases()
+    if not cases:
+        print("No saved outputs found under Output/TestCases or Output/TestData")
+        return
+    total_bytes = sum(len(text) for _, _, text in cases)
+    print(f"{len(cases)} responses, {total_bytes / 1024:.0f} KiB total, {iterations} iterations\n")
+
+    legacy_time, legacy_ok = time_parser(legacy_extract, cases, iterations)
+    new_time, new_ok = time_parser(parse_with_extract_json, cases, iterations)
+
+    print(f"{'parser':<16}{'ms/pass':>10}{'MB/s':>10}{'parsed':>10}")
+    for name, elapsed, ok in [("legacy split", legacy_time, legacy_ok), ("extract_json", new_time, new_ok)]:
+        print(f"{name:<16}{elapsed * 1000:>10.2f}{total_bytes / elapsed / 1e6:>10.1f}{ok:>7}/{len(cases)}")
+    print(f"\nspeedup: {legacy_time / new_time:.2f}x")
+
+    by_kind = {}
+    for name, kind, text in cases:
+        result = extract_json(text)
+        by_kind.setdefault(kind, [0, 0])
+        by_kind[kind][0] += 1
+        by_kind[kind][1] += int(result.ok)
+    print("\nextract_json success by input kind:")
+    for kind, (count, ok) in by_kind.items():
+        print(f"  {kind:<16}{ok}/{count}")
+
+    # Saved raw responses are mostly truncated: count the items parse_agent_response
+    # recovers from them with the items parsed while streaming
+    recovered = [0, 0]
+    for name, kind, text in cases:
+        if kind != "raw_response":
+            continue
+        # Older saved outputs use other list keys (e.g. "test_dATF"); watch the first array
+        first_array = re.search(r'"(\w+)"\s*:\s*\[', text)
+        if not first_array:
+            continue
+        list_key = first_array.group(1)
+        stream = JSONItemStream((list_key,))
+        stream.feed(text)
+        with contextlib.redirect_stdout(io.StringIO()):
+            items = parse_agent_response(text, list_key, stream.items[list_key]).get(list_key) or []
+        recovered[0] += 1
+        recovered[1] += int(bool(items))
+    if recovered[0]:
+        print(f"\nraw responses with items recovered: {recovered[1]}/{recovered[0]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Retrieval of agent results for the chat assistant
+
+The chat used to put every agent result into its system prompt with
+json.dumps(indent=2). Instead, the results of a document are split into
+knowledge items (the analysis summary, each extracted requirement, user story,
+test case and Test Data set) and indexed with BM25, so each chat message only
+carries a short overview plus the items most relevant to the question. Items
+whose ID is named in the question (e.g. "TC-012") are always included.
+
+Indexes are built when a pipeline run finishes and kept per document, keyed by
+a hash of the results they were built from.
+"""
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from json_extract import extract_list
+from prompt_projection import compact_json, estimate_tokens
+
+CHAT_RETRIEVAL_TOP_K = int(os.getenv("CHAT_RETRIEVAL_TOP_K", "8"))
+# Token budget for the retrieved items of one chat message
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "3000"))
+# Documents whose index is kept in memory
+CHAT_INDEX_CACHE_SIZE = int(os.getenv("CHAT_INDEX_CACHE_SIZE", "32"))
+
+# Longest analysis summary included in the overview of every message
+OVERVIEW_SUMMARY_CHARS = 1500
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i in is it its of on or "
+    "that the their there these this to was what when where which who why will with".split()
+)
+
+# US-001, TC_12, TD 7 ... - normalized to "us-1" so that "TC-12" finds "TC-012"
+_item_id = re.compile(r"\b(us|tc|td)[-_ ]?0*(\d+)\b", re.IGNORECASE)
+_word = re.compile(r"[a-z0-9]+")
+
+def normalize_ids(text: str) -> str:
+    return _item_id.sub(lambda m: f" {m.group(1).lower()}-{m.group(2)} ", text)
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase terms without stopwords; item IDs are kept as single terms"""
+    terms = []
+    for part in normalize_ids(text.lower()).split():
+        if _item_id.fullmatch(part):
+            terms.append(part)
+        else:
+            terms.extend(word for word in _word.findall(part) if word not in STOPWORDS)
+    return terms
+
+def mentioned_ids(text: str) -> List[str]:
+    return [f"{m.group(1).lower()}-{m.group(2)}" for m in _item_id.finditer(text)]
+
+@dataclass
+class KnowledgeItem:
+    kind: str       # requirement, user_story, test_case, test_data or selenium_script
+    item_id: str    # normalized ID (e.g. "tc-12"), or "" for items without one
+    references: tuple   # normalized IDs of the user story / test case it belongs to
+    label: str
+    text: str       # what goes into the prompt
+    tokens: int
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of knowledge items"""
+
+    def __init__(self, items: List[KnowledgeItem]):
+        self.items = items
+        self.term_counts = [Counter(tokenize(f"{item.label} {item.text}")) for item in items]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = (sum(self.lengths) / len(items)) if items else 0.0
+        document_frequency = Counter()
+        for counts in self.term_counts:
+            document_frequency.update(counts.keys())
+        total = len(items)
+        self.idf = {
+            term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+        # Term -> items containing it, so a query only scores candidate items
+        self.postings: Dict[str, List[int]] = {}
+        for position, counts in enumerate(self.term_counts):
+            for term in counts:
+                self.postings.setdefault(term, []).append(position)
+
+    def search(self, query: str, top_k: int) -> List[tuple]:
+        """(score, item) of the best matching items, best first"""
+        scores = Counter()
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position in self.postings[term]:
+                frequency = self.term_counts[position][term]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / (self.average_length or 1))
+                scores[position] += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return [(score, self.items[position]) for position, score in scores.most_common(top_k)]
+
+def _item(kind: str, label: str, data, item_id: str = "", references: tuple = ()) -> KnowledgeItem:
+    text = data if isinstance(data, str) else compact_json(data)
+    normalized = mentioned_ids(item_id)
+    references = tuple(ref for value in references if value for ref in mentioned_ids(str(value)))
+    return KnowledgeItem(kind, normalized[0] if normalized else "", references, label, text, estimate_tokens(text))
+
+def build_knowledge_items(agent_results: dict) -> List[KnowledgeItem]:
+    """Split agent results into individually retrievable items"""
+    items = []
+    analysis = agent_results.get("1_requirements_analyst")
+    if isinstance(analysis, dict):
+        for field, values in analysis.items():
+            if field == "summary" or not isinstance(values, list):
+                continue
+            label = field.replace("_", " ").rstrip("s")
+            for value in values:
+                items.append(_item("requirement", label, value))
+
+    # stage, list key, kind, label, ID fields, fields referencing the parent item
+    stages = (
+        ("2_user_story_creator", "user_stories", "user_story", "User story", ("id",), ()),
+        ("3_test_case_generator", "test_cases", "test_case", "Test case", ("test_case_id", "id"), ("user_story_id",)),
+        ("4_test_data_generator", "test_data", "test_data", "Test Data set", ("test_data_id", "id"), ("test_case_id",))
+    )
+    for stage, key, kind, label, id_fields, reference_fields in stages:
+        for index, entry in enumerate(extract_list(agent_results.get(stage), key), start=1):
+            if not isinstance(entry, dict):
+                continue
+            entry = {k: v for k, v in entry.items() if v not in (None, "", [], {})}
+            item_id = next((str(entry[field]) for field in id_fields if entry.get(field)), "")
+            references = tuple(entry.get(field) for field in reference_fields)
+            items.append(_item(kind, f"{label} {item_id or index}", entry, item_id, references))
+
+    selenium = agent_results.get("5_selenium_engineer")
+    if isinstance(selenium, dict) and selenium.get("script"):
+        items.append(_item("selenium_script", "Selenium script", selenium["script"][:2000]))
+    return items
+
+def results_fingerprint(agent_results: dict) -> str:
+    return hashlib.sha256(compact_json(agent_results).encode("utf-8")).hexdigest()
+
+class KnowledgeIndex:
+    """Retrieval index over the agent results of one document"""
+
+    def __init__(self, file_name: str, agent_results: dict, fingerprint: str = None, run_id: str = None):
+        self.file_name = file_name
+        self.run_id = run_id
+        self.fingerprint = fingerprint or results_fingerprint(agent_results)
+        self.items = build_knowledge_items(agent_results)
+        self.bm25 = BM25Index(self.items)
+        self.by_id: Dict[str, List[KnowledgeItem]] = {}
+        self.by_reference: Dict[str, List[KnowledgeItem]] = {}
+        for item in self.items:
+            if item.item_id:
+                self.by_id.setdefault(item.item_id, []).append(item)
+            for reference in item.references:
+                self.by_reference.setdefault(reference, []).append(item)
+        analysis = agent_results.get("1_requirements_analyst")
+        summary = analysis.get("summary", "") if isinstance(analysis, dict) else ""
+        if len(summary) > OVERVIEW_SUMMARY_CHARS:
+            summary = summary[:OVERVIEW_SUMMARY_CHARS].rsplit(" ", 1)[0] + " ..."
+        counts = Counter(item.kind for item in self.items)
+        self.overview = "\n".join(line for line in (
+            f"File: {file_name}",
+            "Contents: " + ", ".join(f"{count} {kind.replace('_', ' ')} item(s)" for kind, count in sorted(counts.items())),
+            f"Requirements summary: {summary}" if summary else ""
+        ) if line)
+        self.full_tokens = estimate_tokens(compact_json(agent_results))
+
+    def retrieve(self, query: str, top_k: int = None, token_budget: int = None) -> List[KnowledgeItem]:
+        """Items to answer a query with, within the token budget
+
+        Items named by ID come first, then the items belonging to them (the
+        test cases of a user story, the Test Data sets of a test case), then
+        the best BM25 matches. Named items do not count towards top_k.
+        """
+        top_k = top_k or CHAT_RETRIEVAL_TOP_K
+        token_budget = token_budget or CHAT_CONTEXT_TOKEN_BUDGET
+        ids = mentioned_ids(query)
+        named = [item for item_id in ids for item in self.by_id.get(item_id, [])]
+        candidates = named + [item for item_id in ids for item in self.by_reference.get(item_id, [])]
+        candidates += [item for _, item in self.bm25.search(query, top_k + len(named))]
+        selected = []
+        seen = set()
+        used = 0
+        for item in candidates:
+            if id(item) in seen or len(selected) >= top_k + len(named):
+                continue
+            if selected and used + item.tokens > token_budget:
+                continue
+            seen.add(id(item))
+            selected.append(item)
+            used += item.tokens
+        return selected
+
+    def render(self, items: List[KnowledgeItem]) -> str:
+        """Knowledge base section of the chat system prompt"""
+        sections = [f"=== OVERVIEW ===\n{self.overview}"]
+        if items:
+            sections.append("=== RELEVANT ITEMS ===\n" + "\n".join(f"[{item.label}] {item.text}" for item in items))
+        else:
+            sections.append("=== RELEVANT ITEMS ===\nNo items matched the question.")
+        return "\n\n".join(sections)
+
+class KnowledgeIndexCache:
+    """Most recently used KnowledgeIndex per document"""
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or CHAT_INDEX_CACHE_SIZE
+        self._indexes: "OrderedDict[str, KnowledgeIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def build(self, file_name: str, agent_results: dict, run_id: str = None) -> KnowledgeIndex:
+        """(Re)build and keep the index of a document's results"""
+        index = KnowledgeIndex(file_name, agent_results, run_id=run_id)
+        with self._lock:
+            self._indexes[file_name] = index
+            self._indexes.move_to_end(file_name)
+            while len(self._indexes) > self.max_size:
+                self._indexes.popitem(last=False)
+        return index
+
+    def get(self, file_name: str, agent_results: Optional[dict] = None) -> Optional[KnowledgeIndex]:
+        """Index of a document, rebuilt if agent_results differ from the indexed ones
+
+        Without agent_results, the index built by the last pipeline run is returned.
+        """
+        with self._lock:
+            index = self._indexes.get(file_name)
+            if index is not None:
+                self._indexes.move_to_end(file_name)
+        if not agent_results:
+            return index
+        fingerprint = results_fingerprint(agent_results)
+        if index is not None and index.fingerprint == fingerprint:
+            return index
+        return self.build(file_name, agent_results)
+
+    def find_run(self, run_id: str) -> Optional[KnowledgeIndex]:
+        """Index built from the results of a pipeline run, if it is still the latest for its document"""
+        with self._lock:
+            return next((index for index in self._indexes.values() if index.run_id == run_id), None)
@@ -0,0 +1,153 @@
+"""
+Server-side chat sessions
+
+A session is opened for a document's pipeline run and keeps the conversation
+history on the server, so each chat turn only sends the new message. Sessions
+are stored in a SQLite database shared by every worker process, so a
+follow-up message can be answered by any worker; the run's knowledge index is
+not stored but rebuilt from the run's results by the worker that needs it
+(and then kept in its index cache). Sessions are evicted after
+CHAT_SESSION_IDLE_SECONDS without a message, or oldest-idle first once
+CHAT_SESSION_MAX are open; a client whose session has expired opens a new one.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from chat_retrieval import KnowledgeIndex
+
+CHAT_SESSIONS_DB_PATH = Path(os.getenv("CHAT_SESSIONS_DB_PATH", str(Path(__file__).parent / ".cache" / "chat_sessions.db")))
+CHAT_SESSION_IDLE_SECONDS = float(os.getenv("CHAT_SESSION_IDLE_SECONDS", "1800"))
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "1000"))
+# Messages of history kept per session (the prompt uses the most recent ones)
+CHAT_SESSION_HISTORY = int(os.getenv("CHAT_SESSION_HISTORY", "20"))
+
+@dataclass
+class ChatSession:
+    session_id: str
+    file_name: str
+    run_id: Optional[str]
+    index: KnowledgeIndex
+    history: List[dict] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+
+    def describe(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "file_name": self.file_name,
+            "run_id": self.run_id,
+            "indexed_items": len(self.index.items),
+            "messages": len(self.history),
+            "idle_timeout_seconds": CHAT_SESSION_IDLE_SECONDS
+        }
+
+class ChatSessionStore:
+    """Open chat sessions in SQLite
+
+    load_index(file_name, run_id) returns the knowledge index of a session's
+    run; it is called each time a session is loaded.
+    """
+
+    def __init__(self, load_index: Callable[[str, Optional[str]], KnowledgeIndex], db_path: Path = None,
+                 idle_seconds: float = None, max_sessions: int = None):
+        self.load_index = load_index
+        self.db_path = Path(db_path or CHAT_SESSIONS_DB_PATH)
+        self.idle_seconds = idle_seconds or CHAT_SESSION_IDLE_SECONDS
+        self.max_sessions = max_sessions or CHAT_SESSION_MAX
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS chat_sessions (
+                    session_id TEXT PRIMARY KEY,
+                    file_name TEXT NOT NULL,
+                    run_id TEXT,
+                    history TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_last_used ON chat_sessions(last_used)")
+
+    @contextmanager
+    def _connect(self):
+        """Connection for one operation: committed (or rolled back) and closed on exit"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _evict(self, conn, now: float) -> int:
+        evicted = conn.execute("DELETE FROM chat_sessions WHERE last_used < ?", (now - self.idle_seconds,)).rowcount
+        evicted += conn.execute(
+            """DELETE FROM chat_sessions WHERE session_id IN (
+                SELECT session_id FROM chat_sessions ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_sessions,)
+        ).rowcount
+        return evicted
+
+    def create(self, file_name: str, run_id: Optional[str], index: KnowledgeIndex) -> ChatSession:
+        session = ChatSession(uuid.uuid4().hex, file_name, run_id, index)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO chat_sessions (session_id, file_name, run_id, history, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (session.session_id, file_name, run_id, "[]", session.created_at, session.last_used)
+            )
+            self._evict(conn, session.last_used)
+        return session
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        """An open session, marked as used; None if it does not exist or has expired"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            self._evict(conn, now)
+            row = conn.execute(
+                "SELECT file_name, run_id, history, created_at FROM chat_sessions WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE chat_sessions SET last_used = ? WHERE session_id = ?", (now, session_id))
+        if row is None:
+            return None
+        file_name, run_id, history, created_at = row
+        return ChatSession(session_id, file_name, run_id, self.load_index(file_name, run_id),
+                           history=json.loads(history), created_at=created_at, last_used=now)
+
+    def add_turn(self, session: ChatSession, message: str, response: str):
+        """Append a question and its answer to the stored history (and to session.history)"""
+        turn = [{"role": "user", "content": message}, {"role": "assistant", "content": response}]
+        with self._lock, self._connect() as conn:
+            # Write lock before reading, so a turn saved by another worker meanwhile is not lost
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT history FROM chat_sessions WHERE session_id = ?", (session.session_id,)).fetchone()
+            history = (json.loads(row[0]) if row else session.history) + turn
+            del history[:-CHAT_SESSION_HISTORY]
+            conn.execute(
+                "UPDATE chat_sessions SET history = ?, last_used = ? WHERE session_id = ?",
+                (json.dumps(history), time.time(), session.session_id)
+            )
+        session.history = history
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock, self._connect() as conn:
+            return conn.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+
+    def evict_idle(self) -> int:
+        with self._lock, self._connect() as conn:
+            return self._evict(conn, time.time())
+
+    def __len__(self) -> int:
+        with self._lock, self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0]
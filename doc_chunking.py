@@ -0,0 +1,165 @@
+"""
+Section-aware chunking of large requirement documents
+
+Documents that do not fit one prompt are split at heading boundaries (the
+markdown-style "#" lines written by docx_extract) into chunks of at most
+DOCUMENT_CHUNK_TOKENS. Consecutive small sections are packed into one chunk;
+a section larger than the budget is split between paragraphs, and each of its
+continuation chunks starts with the section's heading path so the model keeps
+its context. Text without headings is chunked by paragraphs only.
+
+relevant_excerpt picks the chunks of a document that match a query (e.g. the
+user stories of one test case shard), so a prompt that only covers part of
+the document does not carry all of it.
+"""
+import os
+import re
+from dataclasses import dataclass, field
+from typing import List
+
+from chat_retrieval import BM25Index, KnowledgeItem
+from prompt_projection import CHARS_PER_TOKEN, estimate_tokens
+
+# Token budget for the document text of one chunk
+DOCUMENT_CHUNK_TOKENS = int(os.getenv("DOCUMENT_CHUNK_TOKENS", "6000"))
+# Size of the pieces relevant_excerpt chooses from
+EXCERPT_UNIT_TOKENS = 600
+
+_heading_line = re.compile(r"^(#{1,9}) +(\S.*)$")
+
+@dataclass
+class Section:
+    """Text under one heading, up to the next heading"""
+    title: str
+    level: int
+    path: tuple                 # titles of the enclosing headings, outermost first, ending with title
+    lines: list = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.lines).strip("\n")
+
+@dataclass
+class Chunk:
+    """Document text sent to one map prompt"""
+    index: int                  # 1-based
+    headings: list              # heading paths (" > " joined) of the sections in this chunk
+    text: str
+    tokens: int
+
+def split_sections(text: str) -> List[Section]:
+    """Split rendered document text into sections at heading lines
+
+    Text before the first heading becomes a section with an empty title.
+    """
+    sections = [Section("", 0, ())]
+    stack = []   # (level, title) of the enclosing headings
+    for line in text.splitlines():
+        match = _heading_line.match(line)
+        if match:
+            level = len(match.group(1))
+            title = match.group(2).strip()
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+            stack.append((level, title))
+            sections.append(Section(title, level, tuple(t for _, t in stack), [line]))
+        else:
+            sections[-1].lines.append(line)
+    if not sections[0].text.strip():
+        sections.pop(0)
+    return sections
+
+def _split_long_line(line: str, max_chars: int) -> List[str]:
+    """Split a line longer than max_chars at whitespace (or hard, if there is none)"""
+    parts = []
+    while len(line) > max_chars:
+        cut = line.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        parts.append(line[:cut])
+        line = line[cut:].lstrip()
+    parts.append(line)
+    return parts
+
+def _split_section(section: Section, max_tokens: int) -> List[str]:
+    """Split an oversized section between lines; continuations repeat its heading path"""
+    continued = f"{'#' * max(section.level, 1)} {' > '.join(section.path)} (continued)" if section.path else ""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    pieces = []
+    current = []
+    current_chars = 0
+    for line in section.lines:
+        for part in _split_long_line(line, max_chars - len(continued) - 1):
+            if current and current_chars + len(part) + 1 > max_chars:
+                pieces.append("\n".join(current))
+                current = [continued] if continued else []
+                current_chars = len(continued) + 1 if continued else 0
+            current.append(part)
+            current_chars += len(part) + 1
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+def needs_chunking(text: str, max_tokens: int = None) -> bool:
+    return estimate_tokens(text) > (max_tokens or DOCUMENT_CHUNK_TOKENS)
+
+def chunk_document(text: str, max_tokens: int = None) -> List[Chunk]:
+    """Split a document into token-bounded chunks at heading boundaries"""
+    max_tokens = max_tokens or DOCUMENT_CHUNK_TOKENS
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current = []
+    headings = []
+    current_chars = 0
+
+    def flush():
+        nonlocal current_chars
+        if current:
+            chunk_text = "\n\n".join(current)
+            chunks.append(Chunk(len(chunks) + 1, list(headings), chunk_text, estimate_tokens(chunk_text)))
+        current.clear()
+        headings.clear()
+        current_chars = 0
+
+    for section in split_sections(text):
+        section_text = section.text
+        if not section_text.strip():
+            continue
+        heading = " > ".join(section.path)
+        if estimate_tokens(section_text) > max_tokens:
+            flush()
+            for piece in _split_section(section, max_tokens):
+                current.append(piece)
+                if heading:
+                    headings.append(heading)
+                flush()
+            continue
+        if current and current_chars + 2 + len(section_text) > max_chars:
+            flush()
+        current_chars += len(section_text) + (2 if current else 0)
+        current.append(section_text)
+        if heading:
+            headings.append(heading)
+    flush()
+    return chunks
+
+def relevant_excerpt(text: str, query: str, max_tokens: int) -> str:
+    """The parts of a document most relevant to query, in document order, within max_tokens
+
+    Documents that fit max_tokens are returned whole. The document is split at
+    headings into small chunks, which are ranked with BM25 against the query;
+    when nothing matches, the beginning of the document is used.
+    """
+    if not needs_chunking(text, max_tokens):
+        return text
+    units = chunk_document(text, min(EXCERPT_UNIT_TOKENS, max_tokens))
+    items = [KnowledgeItem("section", "", (), " ".join(unit.headings), unit.text, unit.tokens) for unit in units]
+    ranked = [item for _, item in BM25Index(items).search(query, len(items))] or items
+    selected = set()
+    used = 0
+    for item in ranked:
+        if used + item.tokens > max_tokens:
+            continue
+        selected.add(id(item))
+        used += item.tokens
+    return "\n\n[...]\n\n".join(item.text for item in items if id(item) in selected)
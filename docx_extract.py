@@ -0,0 +1,257 @@
+"""
+Streaming text extraction for DOCX files
+
+Parses word/document.xml straight from the zip with iterparse instead of
+building the python-docx object model. Paragraphs, headings (with their level)
+and table rows are emitted in document order, and each element is cleared as
+soon as it has been read, so memory stays bounded by the largest paragraph or
+table row. Unlike joining doc.paragraphs, table content is kept.
+
+styles.xml is often far larger than the document itself, so it is only read
+when a paragraph uses a style other than the built-in Title/HeadingN.
+"""
+import io
+import re
+import zipfile
+from dataclasses import dataclass
+from typing import Iterator, Optional
+try:
+    # Installed with python-docx; faster, and filters iterparse events in C
+    from lxml import etree as ET
+    LXML_AVAILABLE = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    LXML_AVAILABLE = False
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+P, T, TAB, BR, CR = f"{W}p", f"{W}t", f"{W}tab", f"{W}br", f"{W}cr"
+TBL, TR, TC, BODY = f"{W}tbl", f"{W}tr", f"{W}tc", f"{W}body"
+P_STYLE, OUTLINE_LVL, VAL = f"{W}pStyle", f"{W}outlineLvl", f"{W}val"
+# The only elements the extractor looks at
+DOCUMENT_TAGS = (P, T, TAB, BR, CR, TBL, TR, TC, BODY, P_STYLE, OUTLINE_LVL, MC_FALLBACK)
+
+_heading_name = re.compile(r"^heading\s*(\d)$", re.IGNORECASE)
+_builtin_heading_id = re.compile(r"^Heading(\d)$")
+
+@dataclass
+class Block:
+    """A unit of document text"""
+    kind: str        # "heading", "paragraph" or "table_row"
+    text: str
+    level: int = 0   # heading level (0 for the document title)
+    table: int = 0   # 1-based index of the table a row belongs to
+
+def _outline_level(value: str) -> Optional[int]:
+    """Heading level for a w:outlineLvl value (9 means body text)"""
+    if value and value.isdigit() and int(value) < 9:
+        return int(value) + 1
+    return None
+
+def _style_level(style):
+    """(heading level, whether it is set on the style itself rather than inherited)"""
+    name = style.find(f"{W}name")
+    name = name.get(f"{W}val", "").strip() if name is not None else ""
+    if name.lower() == "title":
+        return 0, True
+    match = _heading_name.match(name)
+    if match:
+        return int(match.group(1)), True
+    outline = style.find(f"{W}pPr/{W}outlineLvl")
+    if outline is not None:
+        # An explicit outline level overrides the based-on style (e.g. TOC Heading)
+        return _outline_level(outline.get(f"{W}val")), True
+    return None, False
+
+class _HeadingStyles:
+    """Heading level lookup for paragraph style IDs, following basedOn inheritance
+
+    Built-in Title/HeadingN IDs are resolved without reading styles.xml. Other
+    styles are cut out of the raw styles.xml by their styleId and parsed on
+    their own; the whole file is only parsed if it does not use the usual "w:"
+    prefix.
+    """
+
+    def __init__(self, zf: zipfile.ZipFile):
+        self.zf = zf
+        self._data = None
+        self._root_tag = None   # <w:styles ...> start tag, declaring the namespaces used
+        self._elements = None   # styleId -> element, when the whole file was parsed
+        self._cache = {}
+
+    def level(self, style_id: str, seen: tuple = ()) -> Optional[int]:
+        if not style_id:
+            return None
+        if style_id == "Title":
+            return 0
+        match = _builtin_heading_id.match(style_id)
+        if match:
+            return int(match.group(1))
+        if style_id in self._cache:
+            return self._cache[style_id]
+        level = None
+        style = self._find_style(style_id)
+        if style is not None and style.get(f"{W}type", "paragraph") == "paragraph":
+            level, explicit = _style_level(style)
+            parent = style.find(f"{W}basedOn")
+            if not explicit and parent is not None and parent.get(f"{W}val") not in seen:
+                level = self.level(parent.get(f"{W}val"), seen + (style_id,))
+        self._cache[style_id] = level
+        return level
+
+    def _find_style(self, style_id: str):
+        if self._data is None:
+            try:
+                self._data = self.zf.read("word/styles.xml")
+            except KeyError:
+                self._data = b""
+        if self._root_tag is None and self._elements is None:
+            start = self._data.find(b"<w:styles")
+            end = self._data.find(b">", start)
+            if start != -1 and end != -1 and b"<w:style " in self._data:
+                self._root_tag = self._data[start:end + 1]
+        if self._root_tag is None and self._elements is None and self._data:
+            root = ET.fromstring(self._data)
+            self._elements = {style.get(f"{W}styleId"): style for style in root.iter(f"{W}style")}
+        if self._elements is not None:
+            return self._elements.get(style_id)
+        position = self._data.find(b'w:styleId="' + style_id.encode("utf-8") + b'"')
+        if position == -1:
+            return None
+        start = self._data.rfind(b"<w:style ", 0, position)
+        end = self._data.find(b"</w:style>", position)
+        if start == -1 or end == -1:
+            return None
+        fragment = self._data[start:end + len(b"</w:style>")]
+        wrapper = self._root_tag + fragment + b"</w:styles>"
+        try:
+            return ET.fromstring(wrapper)[0]
+        except ET.ParseError:
+            return None
+
+def _iter_document(xml_file, heading_styles: _HeadingStyles) -> Iterator[Block]:
+    paragraphs = []      # stack of text parts; nested paragraphs come from text boxes
+    levels = []          # heading level of each open paragraph (None for body text)
+    table_depth = 0
+    table_count = 0
+    cells = []           # cells of the current top-level table row
+    cell_parts = []      # paragraphs of the current top-level cell
+    fallback_depth = 0   # inside mc:Fallback, which repeats the mc:Choice content
+    body = None
+
+    def drop_read_blocks():
+        # Cleared elements stay attached to w:body; remove all but the one just
+        # finished (the last child, still referenced by the parser)
+        if body is not None:
+            del body[:-1]
+
+    if LXML_AVAILABLE:
+        events = ET.iterparse(xml_file, events=("start", "end"), tag=DOCUMENT_TAGS)
+    else:
+        events = ET.iterparse(xml_file, events=("start", "end"))
+    for event, elem in events:
+        tag = elem.tag
+        if tag == MC_FALLBACK:
+            fallback_depth += 1 if event == "start" else -1
+            if event == "end":
+                elem.clear()
+            continue
+        if fallback_depth:
+            continue
+
+        if event == "start":
+            if tag == BODY:
+                body = elem
+            elif tag == P:
+                paragraphs.append([])
+                levels.append(None)
+            elif tag == TBL:
+                table_depth += 1
+                if table_depth == 1:
+                    table_count += 1
+            elif tag == TR and table_depth == 1:
+                cells = []
+            elif tag == TC and table_depth == 1:
+                cell_parts = []
+            continue
+
+        if tag == T:
+            if paragraphs:
+                paragraphs[-1].append(elem.text or "")
+        elif tag == P:
+            text = "".join(paragraphs.pop())
+            level = levels.pop()
+            if paragraphs:
+                # Text box inside a paragraph - keep its text with the host paragraph
+                if text:
+                    paragraphs[-1].append(" " + text)
+            elif table_depth:
+                if text.strip():
+                    cell_parts.append(text.strip())
+            elif level is not None and text.strip():
+                yield Block("heading", text.strip(), level=level)
+            else:
+                yield Block("paragraph", text)
+            elem.clear()
+            if not paragraphs and not table_depth:
+                drop_read_blocks()
+        elif tag == TAB:
+            if paragraphs:
+                paragraphs[-1].append("\t")
+        elif tag == BR or tag == CR:
+            if paragraphs:
+                paragraphs[-1].append("\n")
+        elif tag == P_STYLE:
+            if levels:
+                level = heading_styles.level(elem.get(VAL))
+                if level is not None:
+                    levels[-1] = level
+        elif tag == OUTLINE_LVL:
+            if levels:
+                levels[-1] = _outline_level(elem.get(VAL))
+        elif tag == TC and table_depth == 1:
+            cells.append(" ".join(part.replace("\n", " ") for part in cell_parts))
+            elem.clear()
+        elif tag == TR and table_depth == 1:
+            if any(cells):
+                yield Block("table_row", " | ".join(cells), table=table_count)
+            elem.clear()
+        elif tag == TBL:
+            table_depth -= 1
+            elem.clear()
+            if not table_depth:
+                drop_read_blocks()
+        elif tag == BODY:
+            elem.clear()
+
+def iter_docx_blocks(file_content: bytes) -> Iterator[Block]:
+    """Yield the headings, paragraphs and table rows of a DOCX file in document order"""
+    with zipfile.ZipFile(io.BytesIO(file_content)) as zf:
+        with zf.open("word/document.xml") as xml_file:
+            yield from _iter_document(xml_file, _HeadingStyles(zf))
+
+def render_blocks(blocks) -> str:
+    """Render blocks as text: markdown-style headings and one line per table row"""
+    lines = []
+    current_table = 0
+    for block in blocks:
+        if block.kind == "table_row":
+            if block.table != current_table:
+                if lines and lines[-1]:
+                    lines.append("")
+                current_table = block.table
+            lines.append(block.text)
+            continue
+        if current_table:
+            lines.append("")
+            current_table = 0
+        if block.kind == "heading":
+            lines.append(f"{'#' * max(block.level, 1)} {block.text}")
+        else:
+            lines.append(block.text)
+    return "\n".join(lines)
+
+def extract_docx_text(file_content: bytes) -> str:
+    """Extract the text of a DOCX file, including tables"""
+    return render_blocks(iter_docx_blocks(file_content))
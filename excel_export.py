@@ -0,0 +1,181 @@
+"""
+Streaming Excel export of test cases and Test Data
+
+Sheets are written with openpyxl's write-only mode, so rows go straight to the
+file instead of being kept as Cell objects. A write-only sheet emits its column
+widths before the first row, so each sheet is built in one pass over the items
+that formats every row, measures the column widths and (for Test Data) collects
+the union of data fields, and the rows are then streamed out.
+"""
+import json
+from pathlib import Path
+try:
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Alignment
+    from openpyxl.utils import get_column_letter
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    OPENPYXL_AVAILABLE = False
+
+TEST_CASE_HEADERS = ["Test Case ID", "Test Case Name", "Description", "Preconditions", "Test Steps", "Expected Result", "Priority", "Status"]
+TEST_DATA_HEADERS = ["Test Data ID", "Test Case ID", "Data Set Name", "Description"]
+# Test Data keys that are not data fields
+TEST_DATA_STANDARD_FIELDS = {"id", "test_data_id", "test_case_id", "data_set_name", "name", "description", "data", "data_values"}
+MAX_COLUMN_WIDTH = 50
+
+class ColumnWidths:
+    """Longest value per column, measured while rows are produced"""
+
+    def __init__(self):
+        self.lengths = []
+
+    def measure(self, values, start: int = 0):
+        for index, value in enumerate(values, start=start):
+            self.widen(index, len(value) if isinstance(value, str) else len(str(value)))
+
+    def widen(self, index: int, length: int):
+        lengths = self.lengths
+        if index >= len(lengths):
+            lengths.extend([0] * (index + 1 - len(lengths)))
+        if length > lengths[index]:
+            lengths[index] = length
+
+    def apply(self, worksheet):
+        for index, length in enumerate(self.lengths, start=1):
+            worksheet.column_dimensions[get_column_letter(index)].width = min(length + 2, MAX_COLUMN_WIDTH)
+
+def _format_value(value) -> str:
+    return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+def test_case_row(tc: dict, index: int) -> list:
+    """Cells of one test case row (index is 1-based, for missing IDs)"""
+    # Handle different field name variations
+    test_case_id = tc.get("test_case_id") or tc.get("id", f"TC_{index}")
+    test_case_name = tc.get("test_case_name") or tc.get("title", "")
+    description = tc.get("description", "")
+
+    # Handle preconditions - can be string, list, or dict
+    preconditions = tc.get("preconditions", "")
+    if isinstance(preconditions, list):
+        preconditions = "\n".join([str(p) for p in preconditions])
+    elif isinstance(preconditions, dict):
+        preconditions = "\n".join([f"{k}: {v}" for k, v in preconditions.items()])
+    else:
+        preconditions = str(preconditions)
+
+    # Handle test steps
+    test_steps = tc.get("test_steps", [])
+    if isinstance(test_steps, list):
+        test_steps = "\n".join([f"{i+1}. {step}" if isinstance(step, str) else str(step) for i, step in enumerate(test_steps)])
+    else:
+        test_steps = str(test_steps)
+
+    # Handle expected result - can be expected_result or expected_results
+    expected_result = tc.get("expected_result") or tc.get("expected_results", "")
+
+    return [
+        test_case_id,
+        test_case_name,
+        description,
+        preconditions,
+        test_steps,
+        expected_result,
+        tc.get("priority", "Medium"),
+        tc.get("status", "Not Executed")
+    ]
+
+def test_data_values(td: dict):
+    """Data cells of one Test Data set: a {field: value} dict, or a single string
+
+    Data fields are flat at the top level (current format) or nested in
+    "data"/"data_values" (older results); nested lists and scalars become one cell.
+    """
+    values = {k: v for k, v in td.items() if k not in TEST_DATA_STANDARD_FIELDS}
+    if not values:
+        values = td.get("data_values") or td.get("data", {})
+    if isinstance(values, dict):
+        return {field: _format_value(value) for field, value in values.items()}
+    if isinstance(values, list):
+        return "\n".join([str(item) for item in values])
+    return str(values) if values else ""
+
+def _header_cells(worksheet, headers: list) -> list:
+    fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    font = Font(bold=True, color="FFFFFF")
+    alignment = Alignment(horizontal="center", vertical="center")
+    cells = []
+    for header in headers:
+        cell = WriteOnlyCell(worksheet, value=header)
+        cell.fill = fill
+        cell.font = font
+        cell.alignment = alignment
+        cells.append(cell)
+    return cells
+
+def write_test_cases_sheet(workbook, test_cases_list: list):
+    worksheet = workbook.create_sheet("Test Cases")
+    widths = ColumnWidths()
+    widths.measure(TEST_CASE_HEADERS)
+    rows = []
+    for index, tc in enumerate(test_cases_list, start=1):
+        if not isinstance(tc, dict):
+            continue
+        row = test_case_row(tc, index)
+        widths.measure(row)
+        rows.append(row)
+
+    widths.apply(worksheet)
+    worksheet.append(_header_cells(worksheet, TEST_CASE_HEADERS))
+    for row in rows:
+        worksheet.append(row)
+
+def write_test_data_sheet(workbook, test_data_list: list):
+    worksheet = workbook.create_sheet("Test Data")
+    widths = ColumnWidths()
+    widths.measure(TEST_DATA_HEADERS)
+    field_lengths = {}      # data field -> longest value, also collects the union of fields
+    single_length = 0       # longest single-cell (non-dict) data value
+    rows = []
+    for index, td in enumerate(test_data_list, start=1):
+        if not isinstance(td, dict):
+            continue
+        standard = [
+            td.get("test_data_id") or td.get("id", f"TD_{index}"),
+            td.get("test_case_id", ""),
+            td.get("data_set_name") or td.get("name", ""),
+            td.get("description", "")
+        ]
+        widths.measure(standard)
+        values = test_data_values(td)
+        if isinstance(values, dict):
+            for field, value in values.items():
+                if len(value) > field_lengths.get(field, -1):
+                    field_lengths[field] = len(value)
+        else:
+            single_length = max(single_length, len(values))
+        rows.append((standard, values))
+
+    # Data field columns (sorted for consistency), or a generic column if there are none
+    fields = sorted(field_lengths)
+    first_data_column = len(TEST_DATA_HEADERS)
+    widths.measure(fields or ["Test Data Values"], start=first_data_column)
+    for index, field in enumerate(fields, start=first_data_column):
+        widths.widen(index, field_lengths[field])
+    widths.widen(first_data_column, single_length)
+
+    widths.apply(worksheet)
+    worksheet.append(_header_cells(worksheet, TEST_DATA_HEADERS + (fields or ["Test Data Values"])))
+    for standard, values in rows:
+        if isinstance(values, dict):
+            worksheet.append(standard + [values.get(field, "") for field in fields])
+        else:
+            worksheet.append(standard + [values])
+
+def write_test_workbook(excel_file: Path, test_cases_list: list, test_data_list: list) -> Path:
+    """Write the Test Cases and Test Data sheets to excel_file"""
+    workbook = Workbook(write_only=True)
+    write_test_cases_sheet(workbook, test_cases_list)
+    write_test_data_sheet(workbook, test_data_list)
+    workbook.save(excel_file)
+    return excel_file
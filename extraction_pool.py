@@ -0,0 +1,64 @@
+"""
+Process pool for CPU-bound document extraction
+
+Text extraction (DOCX parsing, OCR preprocessing) holds the GIL, so running it
+on the event loop stalls every other request. Extraction functions are run in
+a shared ProcessPoolExecutor instead, created on first use. Functions and
+arguments must be picklable: pass module-level functions and raw bytes.
+
+EXTRACTION_WORKERS sets the pool size (default: CPU count, at most 8); 0 runs
+extraction in the default thread pool, which keeps the loop responsive but
+does not use more than one core.
+"""
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(min(os.cpu_count() or 1, 8))))
+# Seconds before a single extraction is reported as failed (0 disables); the
+# worker itself cannot be interrupted and finishes the task in the background
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", "120"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+def get_extraction_pool() -> Optional[ProcessPoolExecutor]:
+    """Get the process-wide extraction pool (None when EXTRACTION_WORKERS is 0)"""
+    global _pool
+    if EXTRACTION_WORKERS <= 0:
+        return None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS)
+        print(f"Started extraction pool with {EXTRACTION_WORKERS} worker process(es)")
+    return _pool
+
+def shutdown_extraction_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+async def run_extraction(func, *args):
+    """Run func(*args) in the extraction pool and return its result
+
+    A worker that dies (e.g. killed while parsing a malformed file) breaks the
+    whole pool; it is replaced so that later uploads are not affected, and the
+    error is raised for the file that was being extracted.
+    """
+    global _pool
+    loop = asyncio.get_running_loop()
+    pool = get_extraction_pool()
+    future = loop.run_in_executor(pool, func, *args)
+    try:
+        if EXTRACTION_TIMEOUT > 0:
+            return await asyncio.wait_for(future, EXTRACTION_TIMEOUT)
+        return await future
+    except BrokenProcessPool:
+        if _pool is pool and pool is not None:
+            print("Extraction pool broken, restarting it")
+            pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+        raise RuntimeError("Extraction worker process terminated unexpectedly")
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"Extraction timed out after {EXTRACTION_TIMEOUT:.0f}s")
@@ -0,0 +1,449 @@
+"""
+Durable background jobs for long-running pipeline runs
+
+Jobs are persisted in a local SQLite database together with the output of
+every completed pipeline stage, so queued jobs and partially completed runs
+survive a restart. A fixed number of asyncio workers per process execute
+jobs, independently of HTTP concurrency. Several processes can share the
+database; a job is claimed by exactly one worker, which holds a lease on it
+(owner and heartbeat_at) and renews it while the job runs. Jobs whose lease
+has expired - their process stopped or crashed - are put back in the queue
+and resume from their last completed stage; jobs still running in a live
+sibling process are left alone.
+
+Runs executed directly by a request are recorded the same way (start), so
+their completed stages are checkpointed too, and a failed or cancelled run can
+be reopened to resume from its first incomplete stage, either in the request
+that reopens it or in the background queue. Such runs are flagged in_request:
+the workers never take them over, and one whose process stopped is marked
+failed so that its client can resume it.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
+
+JOBS_DB_PATH = Path(os.getenv("JOBS_DB_PATH", str(Path(__file__).parent / ".cache" / "jobs.db")))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# A running job whose lease has not been renewed for this long is considered abandoned
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_INTERVAL = JOB_LEASE_SECONDS / 3
+
+JOB_STATUSES = ("queued", "running", "completed", "failed", "cancelled")
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+INTERRUPTED_ERROR = "Interrupted: the process running the request stopped; resume it with resume_run_id"
+
+class JobCancelled(Exception):
+    """A run executed by a request was stopped by cancel() or because its lease was taken over"""
+
+class JobStore:
+    """SQLite persistence for jobs and their completed stage outputs"""
+
+    def __init__(self, db_path: Path, lease_seconds: float = JOB_LEASE_SECONDS):
+        self.db_path = Path(db_path)
+        self.lease_seconds = lease_seconds
+        # Lease owner for the jobs this process runs
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    in_request INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    heartbeat_at REAL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    error TEXT,
+                    result TEXT
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS job_stages (
+                    job_id TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    output TEXT,
+                    timing TEXT,
+                    completed_at REAL NOT NULL,
+                    PRIMARY KEY (job_id, stage)
+                )"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        """Connection for one operation: committed (or rolled back) and closed on exit"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _row_to_job(self, row) -> dict:
+        if row is None:
+            return None
+        (job_id, kind, params, status, cancel_requested, attempts, in_request, owner,
+         heartbeat_at, created_at, started_at, finished_at, error, result) = row
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "params": json.loads(params),
+            "status": status,
+            "cancel_requested": bool(cancel_requested),
+            "attempts": attempts,
+            "in_request": bool(in_request),
+            "owner": owner,
+            "heartbeat_at": heartbeat_at,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+            "error": error,
+            "result": json.loads(result) if result else None
+        }
+
+    def create(self, job_id: str, kind: str, params: dict) -> dict:
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, kind, json.dumps(params), time.time())
+            )
+        return self.get(job_id)
+
+    def start(self, job_id: str, kind: str, params: dict) -> dict:
+        """Record a run that the calling request executes itself (bypassing the queue) as running"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, status, attempts, in_request, owner, heartbeat_at, created_at, started_at) "
+                "VALUES (?, ?, ?, 'running', 1, 1, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(params), self.owner, now, now, now)
+            )
+        return self.get(job_id)
+
+    def reopen(self, job_id: str, status: str = "queued") -> bool:
+        """Move a failed or cancelled job back to queued, or to running for a resume by the calling request
+
+        Its completed stages are kept, so it restarts after them. False if the
+        job is not failed or cancelled (e.g. another request reopened it first).
+        """
+        if status not in ("queued", "running"):
+            raise ValueError(f"Cannot reopen a job as {status}")
+        with self._lock, self._connect() as conn:
+            if status == "running":
+                now = time.time()
+                return conn.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1, cancel_requested = 0, "
+                    "in_request = 1, owner = ?, heartbeat_at = ?, finished_at = NULL, error = NULL "
+                    "WHERE id = ? AND status IN ('failed', 'cancelled')",
+                    (now, self.owner, now, job_id)
+                ).rowcount == 1
+            return conn.execute(
+                "UPDATE jobs SET status = 'queued', cancel_requested = 0, in_request = 0, finished_at = NULL, error = NULL "
+                "WHERE id = ? AND status IN ('failed', 'cancelled')",
+                (job_id,)
+            ).rowcount == 1
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row)
+
+    def claim_next(self) -> Optional[dict]:
+        """Atomically move the oldest queued job to running under this process's lease and return it"""
+        with self._lock, self._connect() as conn:
+            while True:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' AND in_request = 0 ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                now = time.time()
+                claimed = conn.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1, owner = ?, heartbeat_at = ? "
+                    "WHERE id = ? AND status = 'queued'",
+                    (now, self.owner, now, row[0])
+                ).rowcount
+                if claimed:
+                    conn.commit()
+                    job = conn.execute("SELECT * FROM jobs WHERE id = ?", (row[0],)).fetchone()
+                    return self._row_to_job(job)
+
+    def save_stage(self, job_id: str, stage: str, output, timing: dict = None):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_stages (job_id, stage, output, timing, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, stage, json.dumps(output), json.dumps(timing) if timing else None, time.time())
+            )
+
+    def stages(self, job_id: str) -> Dict[str, dict]:
+        """Completed stages of a job: {stage: {"output", "timing", "completed_at"}}"""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT stage, output, timing, completed_at FROM job_stages WHERE job_id = ? ORDER BY completed_at",
+                (job_id,)
+            ).fetchall()
+        return {
+            stage: {
+                "output": json.loads(output) if output else None,
+                "timing": json.loads(timing) if timing else None,
+                "completed_at": completed_at
+            }
+            for stage, output, timing, completed_at in rows
+        }
+
+    def finish(self, job_id: str, status: str, result: dict = None, error: str = None) -> bool:
+        """Record the outcome of a job this process runs and release its lease
+
+        False if the lease was lost (the job was taken over after it expired).
+        """
+        with self._lock, self._connect() as conn:
+            return conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ?, owner = NULL, heartbeat_at = NULL "
+                "WHERE id = ? AND status = 'running' AND owner = ?",
+                (status, time.time(), json.dumps(result) if result is not None else None, error, job_id, self.owner)
+            ).rowcount == 1
+
+    def requeue(self, job_id: str):
+        """Release a job this process stopped running, for another worker to resume"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, heartbeat_at = NULL "
+                "WHERE id = ? AND status = 'running' AND owner = ?",
+                (job_id, self.owner)
+            )
+
+    def renew_leases(self) -> set:
+        """Extend the lease of every job this process runs; returns their IDs"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND owner = ?", (time.time(), self.owner)
+            )
+            rows = conn.execute("SELECT id FROM jobs WHERE status = 'running' AND owner = ?", (self.owner,)).fetchall()
+        return {row[0] for row in rows}
+
+    def recover_expired(self) -> int:
+        """Settle running jobs whose lease expired (their process is gone)
+
+        They are cancelled if that was requested. Background jobs are requeued;
+        runs executed by a request are marked failed, for the client to resume.
+        """
+        now = time.time()
+        expired = now - self.lease_seconds
+        with self._lock, self._connect() as conn:
+            cancelled = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ?, error = 'Cancelled on request', owner = NULL, "
+                "heartbeat_at = NULL WHERE status = 'running' AND cancel_requested = 1 AND COALESCE(heartbeat_at, 0) < ?",
+                (now, expired)
+            ).rowcount
+            interrupted = conn.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, error = ?, owner = NULL, heartbeat_at = NULL "
+                "WHERE status = 'running' AND in_request = 1 AND COALESCE(heartbeat_at, 0) < ?",
+                (now, INTERRUPTED_ERROR, expired)
+            ).rowcount
+            requeued = conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, heartbeat_at = NULL "
+                "WHERE status = 'running' AND in_request = 0 AND COALESCE(heartbeat_at, 0) < ?",
+                (expired,)
+            ).rowcount
+        return cancelled + interrupted + requeued
+
+    def request_cancel(self, job_id: str) -> Optional[dict]:
+        """Cancel a queued job immediately, or flag a running one for the process holding its lease"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            )
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        return self.get(job_id)
+
+    def cancel_requested(self, job_ids) -> set:
+        job_ids = list(job_ids)
+        if not job_ids:
+            return set()
+        placeholders = ",".join("?" * len(job_ids))
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({placeholders})", job_ids
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in JOB_STATUSES}
+        counts.update(dict(rows))
+        return counts
+
+# handler(job, completed_stages, save_stage) -> result dict
+JobHandler = Callable[[dict, Dict[str, dict], Callable], Awaitable[dict]]
+
+class JobRunner:
+    """Bounded pool of asyncio workers executing jobs from a JobStore"""
+
+    def __init__(self, store: JobStore, workers: int = JOB_WORKERS, poll_interval: float = JOB_POLL_INTERVAL):
+        self.store = store
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.handlers: Dict[str, JobHandler] = {}
+        self._tasks = []
+        self._running = {}        # job_id -> asyncio task executing it
+        self._cancelled = set()   # job_ids cancelled on request (not by shutdown)
+        self._lost = set()        # job_ids whose lease expired and was taken over
+        self._wakeup = None
+
+    def register(self, kind: str, handler: JobHandler):
+        self.handlers[kind] = handler
+
+    def start(self):
+        recovered = self.store.recover_expired()
+        if recovered:
+            print(f"Recovered {recovered} job(s) whose worker stopped")
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(index)) for index in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+
+    async def stop(self):
+        """Stop the workers; jobs they were running are requeued for the next start"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """Wake an idle worker after a job has been submitted"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run_in_request(self, job_id: str, awaitable):
+        """Await a run the calling request executes (see JobStore.start), as a job that can be cancelled
+
+        cancel() - from this or, through the job store, another process - stops
+        it, and JobCancelled is raised instead of cancelling the request.
+        """
+        task = asyncio.ensure_future(awaitable)
+        self._running[job_id] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if job_id in self._lost:
+                raise JobCancelled("Stopped: the run's lease expired and it was marked interrupted") from None
+            if job_id in self._cancelled:
+                raise JobCancelled("Cancelled on request") from None
+            raise
+        finally:
+            self._running.pop(job_id, None)
+            self._cancelled.discard(job_id)
+            self._lost.discard(job_id)
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        job = self.store.request_cancel(job_id)
+        task = self._running.get(job_id)
+        if task is not None:
+            self._cancelled.add(job_id)
+            task.cancel()
+        return job
+
+    async def _maintain(self):
+        """Renew this process's leases, recover expired ones and stop jobs cancelled through another process"""
+        last_renewal = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if time.monotonic() - last_renewal >= JOB_HEARTBEAT_INTERVAL:
+                    last_renewal = time.monotonic()
+                    running = set(self._running)
+                    owned = await asyncio.to_thread(self.store.renew_leases)
+                    for job_id in running - owned:
+                        # Taken over after the lease expired (e.g. the event loop was blocked)
+                        task = self._running.get(job_id)
+                        if task is not None and job_id not in self._lost:
+                            self._lost.add(job_id)
+                            task.cancel()
+                    recovered = await asyncio.to_thread(self.store.recover_expired)
+                    if recovered:
+                        print(f"Recovered {recovered} job(s) whose worker stopped")
+                        self.notify()
+                for job_id in await asyncio.to_thread(self.store.cancel_requested, list(self._running)):
+                    task = self._running.get(job_id)
+                    if task is not None and job_id not in self._cancelled:
+                        self._cancelled.add(job_id)
+                        task.cancel()
+            except Exception as e:
+                print(f"Error maintaining job leases: {e}")
+
+    async def _worker(self, index: int):
+        while True:
+            job = await asyncio.to_thread(self.store.claim_next)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._execute(job)
+
+    async def _execute(self, job: dict):
+        job_id = job["job_id"]
+        handler = self.handlers.get(job["kind"])
+        if handler is None:
+            await asyncio.to_thread(self.store.finish, job_id, "failed", error=f"No handler for job kind '{job['kind']}'")
+            return
+        completed = await asyncio.to_thread(self.store.stages, job_id)
+        save_stage = lambda stage, output, timing=None: self.store.save_stage(job_id, stage, output, timing)
+        task = asyncio.create_task(handler(job, completed, save_stage))
+        self._running[job_id] = task
+        print(f"Job {job_id} started (attempt {job['attempts']}, {len(completed)} stage(s) already completed)")
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if job_id in self._lost:
+                print(f"Job {job_id} stopped: its lease expired and another worker took it over")
+                return
+            if job_id in self._cancelled:
+                # Only the job's task was cancelled; this worker is still running
+                await asyncio.to_thread(self.store.finish, job_id, "cancelled", error="Cancelled on request")
+                print(f"Job {job_id} cancelled")
+                return
+            # Worker shutdown: this task is being cancelled, so an await could be
+            # interrupted before the job is released - requeue it synchronously
+            self.store.requeue(job_id)
+            raise
+        except Exception as e:
+            await asyncio.to_thread(self.store.finish, job_id, "failed", error=str(e))
+            print(f"Job {job_id} failed: {e}")
+        else:
+            await asyncio.to_thread(self.store.finish, job_id, "completed", result=result)
+            print(f"Job {job_id} completed")
+        finally:
+            self._running.pop(job_id, None)
+            self._cancelled.discard(job_id)
+            self._lost.discard(job_id)
+
+_job_store = None
+
+def get_job_store() -> JobStore:
+    """Get the process-wide job store (created on first use)"""
+    global _job_store
+    if _job_store is None:
+        _job_store = JobStore(JOBS_DB_PATH)
+    return _job_store
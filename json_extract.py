@@ -0,0 +1,147 @@
+"""
+Tolerant JSON extraction for LLM responses
+
+Model output often wraps the JSON in ```json fences, adds prose before or after
+it, or (for saved raw_response fields) is itself a JSON-encoded string. Instead
+of splitting on fences and re-scanning the text several times, extract_json
+jumps to the first "{" or "[" and lets the C decoder parse the outermost value
+in place, ignoring whatever follows it. If that value does not parse, the
+search resumes after its closing bracket, never inside it, so a nested
+fragment (e.g. one test case of a truncated response) is not mistaken for the
+whole result.
+"""
+import json
+import re
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from metrics import record_parse_failure
+
+_decoder = json.JSONDecoder()
+_leading_space = re.compile(r"\s*")
+# String literals (possibly unterminated) and brackets, for skipping a value that failed to parse
+_structure = re.compile(r'"(?:[^"\\]|\\.)*"?|[{}\[\]]', re.DOTALL)
+
+# Give up after this many false starts (e.g. brackets in leading prose)
+MAX_CANDIDATES = 20
+
+@dataclass
+class ExtractResult:
+    """Outcome of extract_json with diagnostics for logging"""
+    value: Any = None
+    ok: bool = False
+    method: str = ""            # "object", "direct", "embedded" or "double_encoded"
+    error: Optional[str] = None
+    start: int = -1             # span of the parsed value in the text
+    end: int = -1
+    attempts: int = 0
+
+def _next_candidate(text: str, pos: int) -> int:
+    brace = text.find("{", pos)
+    bracket = text.find("[", pos)
+    if brace == -1:
+        return bracket
+    if bracket == -1:
+        return brace
+    return min(brace, bracket)
+
+def _skip_value(text: str, pos: int) -> int:
+    """Position just after the bracket closing the one at pos, or -1 if it is never closed"""
+    depth = 0
+    for match in _structure.finditer(text, pos):
+        token = match.group()
+        if token in "{[":
+            depth += 1
+        elif token in "}]":
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return -1
+
+def extract_json(text, _depth: int = 0) -> ExtractResult:
+    """Locate and parse the outermost JSON value in an LLM response"""
+    if isinstance(text, (dict, list)):
+        return ExtractResult(value=text, ok=True, method="object")
+    if not isinstance(text, str) or not text:
+        return ExtractResult(error="empty or non-string input")
+
+    result = ExtractResult()
+
+    # Double-encoded JSON: the whole payload is a JSON string literal
+    stripped_start = _leading_space.match(text).end()
+    if _depth == 0 and text.startswith('"', stripped_start):
+        try:
+            inner, end = _decoder.raw_decode(text, stripped_start)
+            if isinstance(inner, str):
+                nested = extract_json(inner, _depth + 1)
+                if nested.ok:
+                    nested.method = "double_encoded"
+                    return nested
+        except json.JSONDecodeError:
+            pass
+
+    pos = _next_candidate(text, 0)
+    while pos != -1 and result.attempts < MAX_CANDIDATES:
+        result.attempts += 1
+        try:
+            value, end = _decoder.raw_decode(text, pos)
+        except json.JSONDecodeError as e:
+            result.error = f"{e.msg} (line {e.lineno}, column {e.colno})"
+            # Only values at the top level are candidates: resume after the failed
+            # value's closing bracket; an unclosed (truncated) value ends the search
+            end = _skip_value(text, pos)
+            pos = _next_candidate(text, end) if end != -1 else -1
+            continue
+        result.value = value
+        result.ok = True
+        result.start = pos
+        result.end = end
+        result.error = None
+        result.method = "direct" if pos == stripped_start else "embedded"
+        return result
+
+    if pos == -1 and result.attempts == 0:
+        result.error = "no JSON object or array found"
+    return result
+
+def extract_list(result: dict, key: str) -> list:
+    """Get a list field from an agent result, falling back to its raw_response"""
+    if not isinstance(result, dict):
+        return []
+    items = result.get(key)
+    if items:
+        return items
+    if "raw_response" not in result:
+        return items or []
+    extracted = extract_json(result["raw_response"])
+    if extracted.ok and isinstance(extracted.value, dict):
+        return extracted.value.get(key) or []
+    if extracted.error:
+        print(f"Could not parse {key} from raw_response: {extracted.error}")
+    return []
+
+def parse_agent_response(text: str, list_key: str, streamed_items: list = None) -> dict:
+    """Parse an agent response that should be a JSON object holding list_key
+
+    Keeps raw_response when the list is missing. If the text cannot be parsed
+    at all (e.g. it was truncated) or the parsed object lacks the list, falls
+    back to the items parsed while streaming.
+    """
+    extracted = extract_json(text)
+    if extracted.ok and isinstance(extracted.value, dict):
+        result_json = extracted.value
+        if not result_json.get(list_key):
+            print(f"Warning: No {list_key} found in parsed JSON. Raw response length: {len(text)}")
+            record_parse_failure(list_key)
+            result_json["raw_response"] = text
+            if streamed_items:
+                result_json[list_key] = streamed_items
+        return result_json
+    
+    print(f"JSON parsing error ({list_key}): {extracted.error or 'not a JSON object'}")
+    record_parse_failure(list_key)
+    print(f"Response preview: {(text or '')[:500]}")
+    return {
+        list_key: streamed_items or [],
+        "raw_response": text
+    }
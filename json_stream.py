@@ -0,0 +1,87 @@
+"""
+Incremental JSON parser for streamed LLM output
+
+Feeds on content deltas as they arrive and yields each element of the watched
+top-level arrays (e.g. "user_stories", "test_cases", "test_data") as soon as its
+closing brace is seen. Only the raw text of the element currently being read
+is buffered. Leading prose and ```json fences are skipped because nothing is
+tracked until the first "{".
+"""
+import json
+
+class JSONItemStream:
+    """Yield completed objects from watched arrays of the root JSON object"""
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.items = {key: [] for key in self.keys}
+        self.errors = 0
+        self._stack = []          # open containers: ("{" | "[", key of the array or None)
+        self._in_string = False
+        self._escape = False
+        self._string_chars = []   # current string, only collected for root object keys
+        self._last_string = None
+        self._current_key = None
+        self._item_chars = None   # text of the element being read from a watched array
+        self._item_key = None
+        self._item_depth = 0
+
+    def feed(self, delta: str) -> list:
+        """Consume a chunk of output and return newly completed (key, item) pairs"""
+        completed = []
+        for ch in delta:
+            if self._item_chars is not None:
+                self._item_chars.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1:
+                        self._last_string = "".join(self._string_chars)
+                elif len(self._stack) == 1:
+                    self._string_chars.append(ch)
+                continue
+
+            if not self._stack:
+                # Outside the JSON value - skip prose and code fences
+                if ch == "{":
+                    self._stack.append(("{", None))
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_chars = []
+            elif ch == ":" and len(self._stack) == 1:
+                self._current_key = self._last_string
+            elif ch == "," and len(self._stack) == 1:
+                self._current_key = None
+            elif ch in "{[":
+                parent, parent_key = self._stack[-1]
+                if ch == "{" and parent == "[" and parent_key in self.keys and self._item_chars is None:
+                    self._item_chars = ["{"]
+                    self._item_key = parent_key
+                    self._item_depth = len(self._stack) + 1
+                key = self._current_key if (ch == "[" and len(self._stack) == 1) else None
+                self._stack.append((ch, key))
+            elif ch in "}]":
+                if self._item_chars is not None and len(self._stack) == self._item_depth:
+                    completed.extend(self._finish_item())
+                self._stack.pop()
+        return completed
+
+    def _finish_item(self) -> list:
+        text = "".join(self._item_chars)
+        key = self._item_key
+        self._item_chars = None
+        self._item_key = None
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError:
+            self.errors += 1
+            return []
+        self.items[key].append(item)
+        return [(key, item)]
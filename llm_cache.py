@@ -0,0 +1,153 @@
+"""
+Content-addressed on-disk cache for LLM chat completions
+
+Entries are keyed on a SHA-256 of (deployment, messages, temperature, max_tokens)
+and stored in a local SQLite database so they survive restarts and are shared
+by every worker process. The cache has a size budget with LRU eviction and a TTL.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", str(Path(__file__).parent / ".cache")))
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "256"))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+def make_cache_key(deployment: str, messages: list, temperature, max_tokens) -> str:
+    """Hash the parameters that determine a completion"""
+    payload = json.dumps(
+        {
+            "deployment": deployment,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class LLMCache:
+    """SQLite-backed completion cache with LRU eviction and TTL"""
+
+    def __init__(self, db_path: Path, max_bytes: int, ttl_seconds: int):
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_completions_last_access ON completions(last_access)")
+
+    @contextmanager
+    def _connect(self):
+        """Connection for one operation: committed (or rolled back) and closed on exit"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str):
+        """Return the cached completion dict, or None on a miss"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT value, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.expired += 1
+                self.misses += 1
+                return None
+            conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(value)
+
+    def put(self, key: str, completion: dict):
+        """Store a completion and evict least-recently-used entries over budget"""
+        value = json.dumps(completion, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now)
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        if self.ttl_seconds:
+            cur = conn.execute("DELETE FROM completions WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            self.expired += cur.rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM completions ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def clear(self) -> int:
+        """Remove every entry, returning the number removed"""
+        with self._lock, self._connect() as conn:
+            return conn.execute("DELETE FROM completions").rowcount
+
+    def stats(self) -> dict:
+        """Hit/miss counters for this process plus on-disk usage"""
+        with self._lock, self._connect() as conn:
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "enabled": LLM_CACHE_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "entries": entries,
+            "size_bytes": total,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds
+        }
+
+_cache = None
+
+def get_llm_cache() -> LLMCache:
+    """Get the process-wide completion cache"""
+    global _cache
+    if _cache is None:
+        _cache = LLMCache(
+            LLM_CACHE_DIR / "llm_cache.db",
+            max_bytes=int(LLM_CACHE_MAX_MB * 1024 * 1024),
+            ttl_seconds=LLM_CACHE_TTL_SECONDS
+        )
+    return _cache
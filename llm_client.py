@@ -0,0 +1,237 @@
+"""
+Shared async Azure OpenAI client used by the ATF and manufacturing backends
+"""
+import asyncio
+import os
+import time
+from contextvars import ContextVar
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+import httpx
+from dotenv import load_dotenv
+from llm_cache import LLM_CACHE_ENABLED, get_llm_cache, make_cache_key
+from json_stream import JSONItemStream
+from llm_governor import BATCH, LLM_MAX_RETRIES, get_llm_governor, retry_delay, retry_reason
+from metrics import record_llm_call, record_llm_error, record_first_token, record_llm_retry
+
+load_dotenv()
+
+AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT", "https://oai-mcm-agentic-flow-nprd01.openai.azure.com/")
+AZURE_DEPLOYMENT = os.getenv("AZURE_DEPLOYMENT", "gpt-4.1")
+AZURE_API_KEY = os.getenv("AZURE_API_KEY", "")
+AZURE_API_VERSION = os.getenv("AZURE_API_VERSION", "2024-08-01-preview")
+
+# Connection pool settings - one pool is shared by every request in the worker
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "600"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+# Ask for token usage on streamed completions (needs an API version with stream_options)
+LLM_STREAM_INCLUDE_USAGE = os.getenv("LLM_STREAM_INCLUDE_USAGE", "false").lower() in ("1", "true", "yes")
+
+# When set, chat_completion streams from the model and passes each content delta
+# to this callback (used by the SSE endpoints to forward tokens as they arrive)
+token_callback: ContextVar = ContextVar("token_callback", default=None)
+# When set, item_callback(key, item) receives each array element parsed from a
+# streamed completion requested with item_keys
+item_callback: ContextVar = ContextVar("item_callback", default=None)
+
+_async_client = None
+
+def get_async_client() -> AsyncAzureOpenAI:
+    """Get the process-wide async Azure OpenAI client (created on first use)"""
+    global _async_client
+    if _async_client is None:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        )
+        # Retries go through the governor (chat_completion), not the SDK
+        _async_client = AsyncAzureOpenAI(
+            azure_endpoint=AZURE_ENDPOINT,
+            api_key=AZURE_API_KEY,
+            api_version=AZURE_API_VERSION,
+            http_client=http_client,
+            max_retries=0
+        )
+    return _async_client
+
+async def close_async_client():
+    """Close the shared client and its connection pool"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+async def chat_completion(messages: list, temperature: float, max_tokens: int, model: str = None, use_cache: bool = True, item_keys: tuple = (), priority: str = BATCH) -> dict:
+    """Run a chat completion through the response cache
+
+    Returns a dict with the completion "content", "finish_reason", "usage" and
+    whether it was served from the cache. Responses cut off by max_tokens are
+    not cached so that a retry gets a fresh attempt.
+
+    With item_keys the completion is streamed and parsed incrementally: each
+    element of those top-level arrays is passed to item_callback as soon as it
+    is complete, and all parsed elements are returned under "items" (usable
+    even when the full output is truncated and fails to parse).
+
+    Calls wait for the rate limit governor at the given priority (INTERACTIVE
+    for chat and classification, BATCH for generation) and are retried on 429
+    and transient errors, unless part of a streamed answer was already passed on.
+    """
+    model = model or AZURE_DEPLOYMENT
+    cache = get_llm_cache() if (use_cache and LLM_CACHE_ENABLED) else None
+    key = make_cache_key(model, messages, temperature, max_tokens) if cache else None
+    on_token = token_callback.get()
+    on_item = item_callback.get()
+    item_stream = JSONItemStream(item_keys) if item_keys else None
+    
+    received = []
+    
+    def handle_delta(delta):
+        received.append(delta)
+        if on_token:
+            on_token(delta)
+        if item_stream:
+            for item_key, item in item_stream.feed(delta):
+                if on_item:
+                    on_item(item_key, item)
+    
+    prompt_tokens = (sum(len(message.get("content") or "") for message in messages) + 3) // 4
+    # The cache is SQLite on disk; keep its I/O off the event loop
+    started = time.perf_counter()
+    completion = await asyncio.to_thread(cache.get, key) if cache else None
+    if completion is not None:
+        completion["cached"] = True
+        if completion["content"]:
+            handle_delta(completion["content"])
+    else:
+        client = get_async_client()
+        governor = get_llm_governor()
+        # Azure counts max_tokens towards the tokens-per-minute limit up front
+        estimated_tokens = prompt_tokens + max_tokens
+        attempt = 0
+        while True:
+            await governor.acquire(estimated_tokens, priority)
+            # Only the API call is timed; governor waits and backoff are recorded separately
+            started = time.perf_counter()
+            try:
+                if on_token is None and item_stream is None:
+                    response = await client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens
+                    )
+                    choice = response.choices[0]
+                    completion = {
+                        "content": choice.message.content or "",
+                        "finish_reason": choice.finish_reason,
+                        "usage": _usage_dict(response.usage)
+                    }
+                else:
+                    completion = await _stream_completion(client, model, messages, temperature, max_tokens, handle_delta)
+                break
+            except BaseException as e:
+                # A failed or cancelled call (client disconnect, job cancel, failed shard)
+                # only used the tokens of what was streamed before it stopped
+                consumed = prompt_tokens + (len("".join(received)) + 3) // 4 if received else 0
+                governor.settle(estimated_tokens, consumed)
+                if not isinstance(e, Exception):
+                    raise
+                reason = None if received else retry_reason(e)
+                if reason is None or attempt >= LLM_MAX_RETRIES:
+                    record_llm_error(e)
+                    raise
+                delay = retry_delay(e, attempt)
+                attempt += 1
+                record_llm_retry(reason, delay)
+                print(f"LLM call failed ({reason}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        usage = completion["usage"]
+        actual_tokens = (usage["prompt_tokens"] + usage["completion_tokens"]) if usage else prompt_tokens + (len(completion["content"]) + 3) // 4
+        governor.settle(estimated_tokens, actual_tokens)
+        if cache and completion["content"] and completion["finish_reason"] != "length":
+            await asyncio.to_thread(cache.put, key, completion)
+        completion["cached"] = False
+    
+    record_llm_call(model, time.perf_counter() - started, completion, prompt_tokens)
+    if item_stream:
+        completion["items"] = item_stream.items
+    return completion
+
+async def stream_chat_completion(messages: list, temperature: float, max_tokens: int, model: str = None, use_cache: bool = True, priority: str = BATCH):
+    """Run chat_completion streamed, as an async iterator of ("token", delta) and finally ("completion", dict)
+
+    Closing the iterator early (e.g. when the client disconnects) cancels the completion.
+    """
+    queue = asyncio.Queue()
+    done = object()
+    
+    async def run():
+        # The task runs in a copy of the context, so the callback only sees this completion
+        token_callback.set(queue.put_nowait)
+        try:
+            return await chat_completion(messages, temperature, max_tokens, model=model, use_cache=use_cache, priority=priority)
+        finally:
+            queue.put_nowait(done)
+    
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            delta = await queue.get()
+            if delta is done:
+                break
+            yield "token", delta
+        yield "completion", await task
+    finally:
+        if not task.done():
+            task.cancel()
+
+def _usage_dict(usage):
+    if not usage:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens
+    }
+
+async def _stream_completion(client, model, messages, temperature, max_tokens, on_delta) -> dict:
+    """Stream a completion, passing each content delta to on_delta"""
+    started = time.perf_counter()
+    extra = {"stream_options": {"include_usage": True}} if LLM_STREAM_INCLUDE_USAGE else {}
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        **extra
+    )
+    parts = []
+    finish_reason = None
+    usage = None
+    async for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        # Azure sends a leading chunk with prompt filter results and no choices
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        delta = choice.delta.content if choice.delta else None
+        if delta:
+            if not parts:
+                record_first_token(model, time.perf_counter() - started)
+            parts.append(delta)
+            on_delta(delta)
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+    return {
+        "content": "".join(parts),
+        "finish_reason": finish_reason,
+        "usage": _usage_dict(usage)
+    }
@@ -0,0 +1,220 @@
+"""
+Process-wide rate limit governor for Azure OpenAI calls
+
+Every completion of the worker acquires a slot from one governor before it is
+sent. The governor keeps requests-per-minute and tokens-per-minute token
+buckets (LLM_RPM_LIMIT / LLM_TPM_LIMIT, 0 = unlimited) matching the
+deployment's quota, and queues calls that would exceed them. Waiting
+interactive calls (chat, form classification) are always granted before
+waiting batch generation calls.
+
+Calls rejected with 429 or a transient 5xx / connection error are retried up
+to LLM_MAX_RETRIES times, after the server's Retry-After or a jittered
+exponential backoff. A Retry-After also pauses the whole governor, so the
+other queued calls do not hammer the endpoint while it is throttling.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from typing import Optional
+
+import openai
+
+from metrics import LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT
+
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "0"))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "0"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+# Longest Retry-After honored; longer ones are capped so a call is not parked for minutes
+LLM_RETRY_AFTER_MAX = float(os.getenv("LLM_RETRY_AFTER_MAX", "120"))
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+RETRYABLE_STATUS = frozenset((408, 429, 500, 502, 503, 504))
+
+class TokenBucket:
+    """Budget refilled continuously up to its per-minute capacity"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount is available (a request larger than the capacity waits for a full bucket)"""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float):
+        # May go below zero; the debt is paid back by the refill
+        self.level -= amount
+
+    def give_back(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+class LLMGovernor:
+    """Rate limit budgets and the priority queue of calls waiting for them"""
+
+    def __init__(self, rpm_limit: int = None, tpm_limit: int = None):
+        rpm_limit = LLM_RPM_LIMIT if rpm_limit is None else rpm_limit
+        tpm_limit = LLM_TPM_LIMIT if tpm_limit is None else tpm_limit
+        self.requests = TokenBucket(rpm_limit) if rpm_limit > 0 else None
+        self.tokens = TokenBucket(tpm_limit) if tpm_limit > 0 else None
+        self.paused_until = 0.0
+        self._waiters = []   # heap of (priority rank, sequence, future, tokens)
+        self._sequence = itertools.count()
+        self._timer = None
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        wait = self.paused_until - now
+        if self.requests:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return max(0.0, wait)
+
+    def _take(self, tokens: int):
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(tokens)
+
+    def _give_back(self, tokens: int):
+        if self.requests:
+            self.requests.give_back(1)
+        if self.tokens:
+            self.tokens.give_back(tokens)
+
+    async def acquire(self, tokens: int, priority: str = BATCH) -> float:
+        """Wait until a call estimated at `tokens` fits the budgets; returns the seconds waited"""
+        if not self._waiters and self._wait_time(tokens, time.monotonic()) == 0:
+            self._take(tokens)
+            LLM_QUEUE_WAIT.observe(0.0, priority=priority)
+            return 0.0
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITIES.index(priority), next(self._sequence), future, tokens))
+        LLM_QUEUE_DEPTH.inc(priority=priority)
+        try:
+            self._dispatch()
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted by _dispatch but cancelled before it could run: return the budget
+                self._give_back(tokens)
+                self._dispatch()
+            raise
+        finally:
+            LLM_QUEUE_DEPTH.dec(priority=priority)
+            if not future.done():
+                # Cancelled while waiting: _dispatch drops it from the heap
+                future.cancel()
+                self._dispatch()
+        waited = time.monotonic() - started
+        LLM_QUEUE_WAIT.observe(waited, priority=priority)
+        return waited
+
+    def _dispatch(self):
+        """Grant waiting calls in priority order while the budgets allow, then sleep until the next one fits"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            _, _, future, tokens = self._waiters[0]
+            if future.done() or future.get_loop().is_closed():
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._wait_time(tokens, time.monotonic())
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self._take(tokens)
+            future.set_result(None)
+
+    def settle(self, estimated: int, actual: Optional[int]):
+        """Correct the tokens budget once a call's actual usage is known"""
+        if self.tokens and actual is not None:
+            difference = estimated - actual
+            if difference > 0:
+                self.tokens.give_back(difference)
+            else:
+                self.tokens.take(-difference)
+
+    def pause(self, seconds: float):
+        """Hold every queued call for `seconds` (the server asked to retry later)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        waiting = [entry for entry in self._waiters if not entry[2].done()]
+        return {
+            "rpm_limit": self.requests.capacity if self.requests else 0,
+            "tpm_limit": self.tokens.capacity if self.tokens else 0,
+            "queued": {priority: sum(1 for entry in waiting if entry[0] == rank)
+                       for rank, priority in enumerate(PRIORITIES)},
+            "paused_seconds": round(max(0.0, self.paused_until - now), 3)
+        }
+
+_governor = None
+
+def get_llm_governor() -> LLMGovernor:
+    """Get the process-wide governor (created on first use)"""
+    global _governor
+    if _governor is None:
+        _governor = LLMGovernor()
+    return _governor
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Delay asked for by the server's retry-after-ms / Retry-After header, if any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # HTTP-date form; Azure sends seconds, so fall back to the backoff
+        return None
+    return None
+
+def retry_reason(error: Exception) -> Optional[str]:
+    """Short reason for a retryable error (used as metrics label), None if it should not be retried"""
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    status = getattr(error, "status_code", None)
+    if status in RETRYABLE_STATUS:
+        return str(status)
+    return None
+
+def backoff_delay(attempt: int) -> float:
+    """Full jitter exponential backoff for the given retry attempt (0-based)"""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying; a Retry-After also pauses the governor"""
+    retry_after = retry_after_seconds(error)
+    if retry_after is None:
+        return backoff_delay(attempt)
+    retry_after = min(max(retry_after, 0.0), LLM_RETRY_AFTER_MAX)
+    get_llm_governor().pause(retry_after)
+    # A little jitter so the retried calls do not all arrive at once
+    return retry_after + random.uniform(0, LLM_BACKOFF_BASE)
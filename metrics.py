@@ -0,0 +1,270 @@
+"""
+In-process metrics exported in the Prometheus text format
+
+A small registry of labelled counters, gauges and histograms shared by the ATF and
+manufacturing backends. Agents run inside agent_span() so that the LLM calls
+and file writes they make are attributed to them through the current_agent
+context variable, including calls made from concurrent shards.
+"""
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Seconds - LLM calls routinely take tens of seconds, so extend past the usual 10s
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Agent the current task is working for ("none" outside any agent)
+current_agent: ContextVar = ContextVar("current_agent", default="none")
+# Outcome of the innermost agent_span, so handlers that answer an error with a
+# fallback response can still record it as failed (see record_agent_error)
+_span_outcome: ContextVar = ContextVar("span_outcome", default=None)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Gauge:
+    """Value that goes up and down, with labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram with labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}   # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        for key, (bucket_counts, total, count) in values:
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {bucket_count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Registry:
+    """Collection of metrics rendered together on /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "http_requests_total", "HTTP requests by route and status code", ("method", "route", "status")))
+HTTP_DURATION = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "HTTP request wall time", ("method", "route")))
+AGENT_DURATION = REGISTRY.register(Histogram(
+    "agent_duration_seconds", "Agent wall time", ("agent", "status")))
+AGENT_ERRORS = REGISTRY.register(Counter(
+    "agent_errors_total", "Agent runs that failed, including errors answered with a fallback response", ("agent", "error")))
+LLM_DURATION = REGISTRY.register(Histogram(
+    "llm_request_duration_seconds", "Time spent waiting on the LLM (including streaming)", ("agent", "model", "cached")))
+LLM_FIRST_TOKEN = REGISTRY.register(Histogram(
+    "llm_time_to_first_token_seconds", "Time until the first streamed content delta", ("agent", "model")))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "llm_tokens_total", "LLM tokens by type; source is 'usage' when reported by the API, else 'estimate'", ("agent", "type", "source")))
+LLM_FINISH_REASONS = REGISTRY.register(Counter(
+    "llm_finish_reason_total", "LLM completions by finish_reason", ("agent", "finish_reason")))
+LLM_ERRORS = REGISTRY.register(Counter(
+    "llm_errors_total", "LLM calls that raised", ("agent", "error")))
+LLM_RETRIES = REGISTRY.register(Counter(
+    "llm_retries_total", "LLM calls retried after a rate limit or transient error", ("agent", "reason")))
+LLM_RETRY_BACKOFF = REGISTRY.register(Histogram(
+    "llm_retry_backoff_seconds", "Delay before retrying a failed LLM call (Retry-After or backoff)", ("agent", "reason")))
+LLM_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "llm_queue_depth", "LLM calls waiting for the rate limit governor", ("priority",)))
+LLM_QUEUE_WAIT = REGISTRY.register(Histogram(
+    "llm_queue_wait_seconds", "Time LLM calls waited for the rate limit governor", ("priority",)))
+PARSE_FAILURES = REGISTRY.register(Counter(
+    "agent_parse_failures_total", "Agent responses whose JSON could not be parsed", ("agent", "key")))
+FILE_WRITE_DURATION = REGISTRY.register(Histogram(
+    "file_write_duration_seconds", "Time spent writing output files", ("agent", "kind")))
+
+def render_metrics() -> str:
+    return REGISTRY.render()
+
+@contextmanager
+def agent_span(name: str):
+    """Attribute nested LLM calls and file writes to an agent and record its wall time"""
+    reset_token = current_agent.set(name)
+    outcome = {"status": "success"}
+    outcome_token = _span_outcome.set(outcome)
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        if outcome["status"] == "success":
+            AGENT_ERRORS.inc(agent=name, error=type(e).__name__)
+        outcome["status"] = "error"
+        raise
+    finally:
+        AGENT_DURATION.observe(time.perf_counter() - started, agent=name, status=outcome["status"])
+        _span_outcome.reset(outcome_token)
+        current_agent.reset(reset_token)
+
+def record_agent_error(error: BaseException):
+    """Record the current agent span as failed when its error is answered with a fallback instead of raised"""
+    outcome = _span_outcome.get()
+    if outcome is not None and outcome["status"] == "success":
+        outcome["status"] = "error"
+        AGENT_ERRORS.inc(agent=current_agent.get(), error=type(error).__name__)
+
+def instrument_agent(name: str):
+    """Decorator running an async agent function inside agent_span(name)"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with agent_span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def time_file_write(kind: str):
+    """Record how long writing an output file takes"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        FILE_WRITE_DURATION.observe(time.perf_counter() - started, agent=current_agent.get(), kind=kind)
+
+def record_parse_failure(key: str):
+    PARSE_FAILURES.inc(agent=current_agent.get(), key=key)
+
+def record_llm_call(model: str, duration: float, completion: dict, prompt_tokens_estimate: int):
+    """Record wait time, token usage and finish_reason of a chat completion"""
+    agent = current_agent.get()
+    cached = completion.get("cached", False)
+    LLM_DURATION.observe(duration, agent=agent, model=model, cached=str(cached).lower())
+    if cached:
+        return
+    LLM_FINISH_REASONS.inc(agent=agent, finish_reason=completion.get("finish_reason") or "unknown")
+    usage = completion.get("usage")
+    if usage:
+        LLM_TOKENS.inc(usage["prompt_tokens"], agent=agent, type="prompt", source="usage")
+        LLM_TOKENS.inc(usage["completion_tokens"], agent=agent, type="completion", source="usage")
+    else:
+        # Streamed responses only carry usage with LLM_STREAM_INCLUDE_USAGE
+        completion_tokens_estimate = (len(completion.get("content") or "") + 3) // 4
+        LLM_TOKENS.inc(prompt_tokens_estimate, agent=agent, type="prompt", source="estimate")
+        LLM_TOKENS.inc(completion_tokens_estimate, agent=agent, type="completion", source="estimate")
+
+def record_llm_error(error: BaseException):
+    LLM_ERRORS.inc(agent=current_agent.get(), error=type(error).__name__)
+
+def record_llm_retry(reason: str, delay: float):
+    agent = current_agent.get()
+    LLM_RETRIES.inc(agent=agent, reason=reason)
+    LLM_RETRY_BACKOFF.observe(delay, agent=agent, reason=reason)
+
+def record_first_token(model: str, duration: float):
+    LLM_FIRST_TOKEN.observe(duration, agent=current_agent.get(), model=model)
+
+def install_http_metrics(app):
+    """Add middleware recording request counts and latency per route template"""
+    @app.middleware("http")
+    async def http_metrics_middleware(request, call_next):
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = request.scope.get("route")
+            # Unmatched paths are grouped to keep label cardinality bounded
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUESTS.inc(method=request.method, route=path, status=status)
+            HTTP_DURATION.observe(time.perf_counter() - started, method=request.method, route=path)
@@ -0,0 +1,114 @@
+"""
+Small dependency-graph executor for the agent pipeline
+
+Each node declares the nodes whose outputs it consumes; nodes whose dependencies
+are satisfied run concurrently. Agent nodes return awaitables and run on the
+event loop; side-effect nodes (file writes, Excel export) are plain blocking
+functions and run in a worker thread.
+"""
+import asyncio
+import inspect
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+class PipelineNode:
+    """A pipeline stage: func(inputs) receives a dict of dependency outputs by node name
+
+    func returns an awaitable, or for side_effect nodes is a blocking function
+    that is run in a worker thread.
+    """
+
+    def __init__(self, name: str, func: Callable, depends_on: Iterable[str] = (), label: str = None, side_effect: bool = False):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.label = label or name
+        self.side_effect = side_effect
+
+class PipelineError(Exception):
+    """Raised when a node fails; carries the failing node and timings so far"""
+
+    def __init__(self, node: str, error: Exception, outputs: dict, timings: dict):
+        super().__init__(f"Pipeline stage '{node}' failed: {error}")
+        self.node = node
+        self.error = error
+        self.outputs = outputs
+        self.timings = timings
+
+async def _run_node(node: PipelineNode, inputs: dict):
+    if node.side_effect:
+        return await asyncio.to_thread(node.func, inputs)
+    return await node.func(inputs)
+
+async def run_pipeline(nodes: list, on_event: Optional[Callable] = None, completed: Optional[Dict] = None):
+    """Run nodes in dependency order, concurrently where possible
+
+    completed maps node names to outputs from an earlier attempt; those nodes are
+    skipped. on_event(event, data) is called with stage_started, stage_completed
+    and stage_failed; if it returns an awaitable (e.g. a checkpoint written in
+    a thread), that is awaited. Returns (outputs, timings), where timings has
+    each node's start offset and duration in milliseconds.
+    """
+    names = {node.name for node in nodes}
+    for node in nodes:
+        missing = [dep for dep in node.depends_on if dep not in names]
+        if missing:
+            raise ValueError(f"Node '{node.name}' depends on unknown node(s): {', '.join(missing)}")
+
+    async def emit(event, data):
+        if on_event is not None:
+            result = on_event(event, data)
+            if inspect.isawaitable(result):
+                await result
+    outputs = {}
+    timings = {}
+    pending = {}
+    for node in nodes:
+        if completed and node.name in completed:
+            outputs[node.name] = completed[node.name]
+            timings[node.name] = {"status": "skipped", "started_ms": 0.0, "duration_ms": 0.0}
+        else:
+            pending[node.name] = node
+
+    pipeline_start = time.perf_counter()
+    running = {}
+    try:
+        while pending or running:
+            for name, node in list(pending.items()):
+                if all(dep in outputs for dep in node.depends_on):
+                    del pending[name]
+                    inputs = {dep: outputs[dep] for dep in node.depends_on}
+                    started = time.perf_counter()
+                    await emit("stage_started", {"stage": name, "agent_name": node.label})
+                    task = asyncio.create_task(_run_node(node, inputs))
+                    running[task] = (node, started)
+
+            if not running:
+                raise ValueError(f"Unsatisfiable dependencies for node(s): {', '.join(pending)}")
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node, started = running.pop(task)
+                finished = time.perf_counter()
+                timing = {
+                    "started_ms": round((started - pipeline_start) * 1000, 1),
+                    "duration_ms": round((finished - started) * 1000, 1)
+                }
+                try:
+                    outputs[node.name] = task.result()
+                except Exception as e:
+                    timings[node.name] = {"status": "failed", **timing}
+                    await emit("stage_failed", {"stage": node.name, "agent_name": node.label, "error": str(e)})
+                    raise PipelineError(node.name, e, outputs, timings) from e
+                timings[node.name] = {"status": "completed", **timing}
+                await emit("stage_completed", {
+                    "stage": node.name,
+                    "agent_name": node.label,
+                    "result": outputs[node.name],
+                    "timing": timings[node.name]
+                })
+    finally:
+        for task in running:
+            task.cancel()
+
+    return outputs, timings
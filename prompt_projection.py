@@ -0,0 +1,133 @@
+"""
+Compact projections of upstream agent results for downstream prompts
+
+The test case and test data prompts used to embed the whole previous result with
+json.dumps(indent=2), including agent_name, timestamp and sometimes the full
+duplicated raw_response. These helpers keep only the fields each stage needs,
+serialize them without indentation and fit them into a token budget: first with
+the needed fields, then with a shorter summary projection, and finally by
+splitting the items into shards that each fit the budget.
+"""
+import json
+import os
+
+from json_extract import extract_list
+
+# Token budget for the upstream artifact embedded in one prompt
+PROMPT_UPSTREAM_TOKEN_BUDGET = int(os.getenv("PROMPT_UPSTREAM_TOKEN_BUDGET", "12000"))
+
+# Rough average for English prose and JSON with GPT-4 class tokenizers
+CHARS_PER_TOKEN = 4
+
+USER_STORY_FIELDS = ("id", "title", "user_story", "acceptance_criteria", "priority")
+USER_STORY_SUMMARY_FIELDS = ("id", "title", "user_story")
+TEST_CASE_FIELDS = ("id", "title", "description", "preconditions", "expected_results", "test_type", "user_story_id")
+TEST_CASE_SUMMARY_FIELDS = ("id", "title", "expected_results", "user_story_id")
+
+# Alternate field names the models use for the same thing
+FIELD_ALIASES = {
+    "id": ("id", "test_case_id"),
+    "title": ("title", "test_case_name"),
+    "expected_results": ("expected_results", "expected_result")
+}
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the token count of a string"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def compact_json(data) -> str:
+    """Serialize without indentation or spaces after separators"""
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+def project_items(items: list, fields: tuple) -> list:
+    """Keep only the given fields of each item, resolving alternate field names"""
+    projected = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        compact = {}
+        for field in fields:
+            for name in FIELD_ALIASES.get(field, (field,)):
+                value = item.get(name)
+                if value not in (None, "", []):
+                    compact[field] = value
+                    break
+        projected.append(compact)
+    return projected
+
+def _shard_to_budget(items: list, budget: int) -> list:
+    """Greedily split items into shards whose compact JSON fits the budget"""
+    shards = []
+    current = []
+    current_tokens = 0
+    for item in items:
+        item_tokens = estimate_tokens(compact_json(item)) + 1
+        if current and current_tokens + item_tokens > budget:
+            shards.append(current)
+            current = []
+            current_tokens = 0
+        current.append(item)
+        current_tokens += item_tokens
+    if current:
+        shards.append(current)
+    return shards
+
+def project_result(result: dict, list_key: str, fields: tuple, summary_fields: tuple, budget: int = None, shard_size: int = 0):
+    """Project an upstream agent result for a downstream prompt
+
+    Returns (shards, report). Each shard is a list of projected items that fits
+    the token budget; there is a single shard unless even the summary
+    projection is too large, or shard_size is set and there are more items
+    than that. The report compares the projected size with the indented dump
+    of the full result that used to be sent.
+    """
+    budget = budget or PROMPT_UPSTREAM_TOKEN_BUDGET
+    result = result or {}
+    items = extract_list(result, list_key)
+    original = {k: v for k, v in result.items() if k not in ("timestamp", "cached")}
+    original_tokens = estimate_tokens(json.dumps(original, indent=2))
+
+    level = "full"
+    projected = project_items(items, fields)
+    projected_tokens = estimate_tokens(compact_json({list_key: projected}))
+    shards = [projected]
+    if shard_size and len(projected) > shard_size:
+        level = "sharded"
+        shards = []
+        for i in range(0, len(projected), shard_size):
+            shards.extend(_shard_to_budget(projected[i:i + shard_size], budget))
+    elif projected_tokens > budget:
+        summary = project_items(items, summary_fields)
+        summary_tokens = estimate_tokens(compact_json({list_key: summary}))
+        if summary_tokens <= budget:
+            level = "summary"
+            shards = [summary]
+            projected_tokens = summary_tokens
+        else:
+            level = "sharded"
+            shards = _shard_to_budget(projected, budget)
+    if len(shards) > 1:
+        projected_tokens = sum(estimate_tokens(compact_json({list_key: shard})) for shard in shards)
+
+    report = {
+        "items": len(items),
+        "level": level,
+        "shards": len(shards),
+        "original_tokens": original_tokens,
+        "projected_tokens": projected_tokens,
+        "saved_tokens": max(original_tokens - projected_tokens, 0),
+        "budget_tokens": budget
+    }
+    return shards, report
+
+def summarize_savings(reports: dict) -> dict:
+    """Total the per-stage projection reports for a pipeline run"""
+    original = sum(report["original_tokens"] for report in reports.values())
+    projected = sum(report["projected_tokens"] for report in reports.values())
+    return {
+        "stages": reports,
+        "original_tokens": original,
+        "projected_tokens": projected,
+        "saved_tokens": max(original - projected, 0),
+        "saved_percent": round(100 * (original - projected) / original, 1) if original else 0.0
+    }
@@ -0,0 +1,60 @@
+"""
+Tests for chat_sessions (run with: python -m pytest test_chat_sessions.py)
+"""
+import threading
+
+from chat_retrieval import KnowledgeIndex
+from chat_sessions import CHAT_SESSION_HISTORY, ChatSessionStore
+
+def make_store(db_path, **kwargs) -> ChatSessionStore:
+    return ChatSessionStore(load_index=lambda file_name, run_id: KnowledgeIndex(file_name, {}, run_id=run_id),
+                            db_path=db_path, **kwargs)
+
+def test_session_is_shared_by_stores_on_the_same_database(tmp_path):
+    first = make_store(tmp_path / "chat.db")
+    second = make_store(tmp_path / "chat.db")
+    session = first.create("spec.docx", "run1", KnowledgeIndex("spec.docx", {}, run_id="run1"))
+    first.add_turn(session, "question", "answer")
+    loaded = second.get(session.session_id)
+    assert loaded.file_name == "spec.docx" and loaded.run_id == "run1"
+    assert loaded.history == [{"role": "user", "content": "question"}, {"role": "assistant", "content": "answer"}]
+    assert second.delete(session.session_id)
+    assert first.get(session.session_id) is None
+
+def test_concurrent_turns_are_both_kept(tmp_path):
+    stores = [make_store(tmp_path / "chat.db") for _ in range(2)]
+    session_id = stores[0].create("spec.docx", None, KnowledgeIndex("spec.docx", {})).session_id
+    # Each "worker" loaded the session before the other saved its turn
+    sessions = [store.get(session_id) for store in stores]
+    threads = [
+        threading.Thread(target=store.add_turn, args=(session, f"question {i}", f"answer {i}"))
+        for i, (store, session) in enumerate(zip(stores, sessions))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    history = stores[0].get(session_id).history
+    assert sorted(message["content"] for message in history if message["role"] == "user") == ["question 0", "question 1"]
+    assert len(history) == 4
+
+def test_history_is_trimmed(tmp_path):
+    store = make_store(tmp_path / "chat.db")
+    session = store.create("spec.docx", None, KnowledgeIndex("spec.docx", {}))
+    for i in range(CHAT_SESSION_HISTORY):
+        store.add_turn(session, f"question {i}", f"answer {i}")
+    history = store.get(session.session_id).history
+    assert len(history) == CHAT_SESSION_HISTORY
+    assert history[-1] == {"role": "assistant", "content": f"answer {CHAT_SESSION_HISTORY - 1}"}
+    assert session.history == history
+
+def test_idle_and_excess_sessions_are_evicted(tmp_path):
+    store = make_store(tmp_path / "chat.db", max_sessions=2)
+    index = KnowledgeIndex("spec.docx", {})
+    ids = [store.create("spec.docx", None, index).session_id for _ in range(3)]
+    assert len(store) == 2
+    assert store.get(ids[0]) is None
+    with store._connect() as conn:
+        conn.execute("UPDATE chat_sessions SET last_used = 0 WHERE session_id = ?", (ids[1],))
+    assert store.evict_idle() == 1
+    assert store.get(ids[2]) is not None
@@ -0,0 +1,90 @@
+"""
+Tests for the job store leases (run with: python -m pytest test_jobs.py)
+"""
+import asyncio
+import time
+
+from jobs import INTERRUPTED_ERROR, JobCancelled, JobRunner, JobStore
+
+def expire(store: JobStore, job_id: str):
+    with store._connect() as conn:
+        conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time() - store.lease_seconds - 1, job_id))
+
+def test_claim_takes_a_lease(tmp_path):
+    store = JobStore(tmp_path / "jobs.db")
+    store.create("j1", "k", {})
+    job = store.claim_next()
+    assert job["job_id"] == "j1" and job["status"] == "running"
+    assert job["owner"] == store.owner and job["heartbeat_at"]
+    assert store.claim_next() is None
+
+def test_recover_expired_only_takes_expired_leases(tmp_path):
+    owner = JobStore(tmp_path / "jobs.db", lease_seconds=60)
+    sibling = JobStore(tmp_path / "jobs.db", lease_seconds=60)
+    for job_id in ("live", "dead"):
+        owner.create(job_id, "k", {})
+        owner.claim_next()
+    expire(owner, "dead")
+    assert sibling.recover_expired() == 1
+    assert sibling.get("live")["status"] == "running"
+    dead = sibling.get("dead")
+    assert dead["status"] == "queued" and dead["owner"] is None
+    # The old owner has lost it and can no longer record an outcome
+    assert not owner.finish("dead", "completed", result={})
+    assert owner.finish("live", "completed", result={"ok": True})
+    assert owner.get("live")["owner"] is None
+
+def test_renew_keeps_the_lease(tmp_path):
+    store = JobStore(tmp_path / "jobs.db", lease_seconds=60)
+    store.create("j1", "k", {})
+    store.claim_next()
+    expire(store, "j1")
+    assert store.renew_leases() == {"j1"}
+    assert store.recover_expired() == 0
+
+def test_expired_cancel_request_is_cancelled_not_requeued(tmp_path):
+    store = JobStore(tmp_path / "jobs.db")
+    store.create("j1", "k", {})
+    store.claim_next()
+    store.request_cancel("j1")
+    expire(store, "j1")
+    store.recover_expired()
+    assert store.get("j1")["status"] == "cancelled"
+
+def test_expired_request_run_is_failed_not_queued(tmp_path):
+    store = JobStore(tmp_path / "jobs.db")
+    store.start("r1", "k", {})
+    expire(store, "r1")
+    store.recover_expired()
+    run = store.get("r1")
+    assert run["status"] == "failed" and run["error"] == INTERRUPTED_ERROR
+    assert store.claim_next() is None
+    # Resumed in the background, it becomes an ordinary job
+    assert store.reopen("r1", "queued")
+    assert store.claim_next()["job_id"] == "r1"
+
+def test_requeue_only_by_owner(tmp_path):
+    owner = JobStore(tmp_path / "jobs.db")
+    other = JobStore(tmp_path / "jobs.db")
+    owner.create("j1", "k", {})
+    owner.claim_next()
+    other.requeue("j1")
+    assert owner.get("j1")["status"] == "running"
+    owner.requeue("j1")
+    assert owner.get("j1")["status"] == "queued"
+
+def test_cancel_stops_a_request_run(tmp_path):
+    store = JobStore(tmp_path / "jobs.db")
+    runner = JobRunner(store)
+    store.start("r1", "k", {})
+
+    async def run():
+        task = asyncio.create_task(runner.run_in_request("r1", asyncio.sleep(3600)))
+        await asyncio.sleep(0)
+        runner.cancel("r1")
+        try:
+            await task
+        except JobCancelled as e:
+            return str(e)
+    assert asyncio.run(run()) == "Cancelled on request"
+    assert store.get("r1")["cancel_requested"]
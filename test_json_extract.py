@@ -0,0 +1,53 @@
+"""
+Tests for json_extract (run with: python -m pytest test_json_extract.py)
+"""
+import json
+
+from json_extract import extract_json, parse_agent_response
+
+TEST_CASES = [{"id": "TC-001", "title": "Valid login"}, {"id": "TC-002", "title": "Invalid password"}]
+
+def test_fenced_object_with_prose():
+    text = f"Here you go:\n```json\n{json.dumps({'test_cases': TEST_CASES})}\n```\nDone."
+    result = extract_json(text)
+    assert result.ok and result.method == "embedded"
+    assert result.value["test_cases"] == TEST_CASES
+
+def test_syntax_error_before_nested_object_is_not_a_result():
+    # The error in the first test case must not make the second one the result
+    text = '{"test_cases": [{"id": "TC-001", "title": oops}, {"id": "TC-002", "title": "Invalid password"}], "summary": "s"}'
+    result = extract_json(text)
+    assert not result.ok
+    assert result.value is None
+
+def test_truncated_response_is_not_a_result():
+    text = '```json\n{"test_cases": [{"id": "TC-001", "title": "Valid login"}, {"id": "TC-002", "title": "Inva'
+    assert not extract_json(text).ok
+
+def test_top_level_value_after_failed_one():
+    text = 'Notes [see below, oops} then {"test_cases": [{"id": "TC-001"}]}'
+    result = extract_json(text)
+    assert result.ok
+    assert result.value == {"test_cases": [{"id": "TC-001"}]}
+
+def test_brackets_inside_strings_are_ignored_when_skipping():
+    text = '{"note": "a } and a ] inside", "bad": x} {"test_cases": []}'
+    result = extract_json(text)
+    assert result.ok
+    assert result.value == {"test_cases": []}
+
+def test_double_encoded():
+    text = json.dumps(json.dumps({"test_cases": TEST_CASES}))
+    result = extract_json(text)
+    assert result.ok and result.method == "double_encoded"
+
+def test_parse_agent_response_falls_back_to_streamed_items():
+    text = '{"test_cases": [{"id": "TC-001", "title": oops}, {"id": "TC-002", "title": "Invalid password"}]}'
+    result = parse_agent_response(text, "test_cases", TEST_CASES)
+    assert result["test_cases"] == TEST_CASES
+    assert result["raw_response"] == text
+
+def test_parse_agent_response_uses_streamed_items_when_list_is_missing():
+    result = parse_agent_response('{"summary": "no list"}', "test_cases", TEST_CASES)
+    assert result["test_cases"] == TEST_CASES
+    assert "raw_response" in result
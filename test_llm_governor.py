@@ -0,0 +1,85 @@
+"""
+Tests for llm_governor (run with: python -m pytest test_llm_governor.py)
+"""
+import asyncio
+
+import pytest
+
+from llm_governor import BATCH, INTERACTIVE, LLMGovernor, TokenBucket
+
+def test_token_bucket_wait_time():
+    bucket = TokenBucket(60)  # one per second
+    now = bucket.updated
+    assert bucket.wait_time(10, now) == 0
+    bucket.take(60)
+    assert bucket.wait_time(2, now) == pytest.approx(2.0)
+    # A request larger than the capacity waits for a full bucket, not forever
+    assert bucket.wait_time(600, now) == pytest.approx(60.0)
+
+def test_interactive_granted_before_batch():
+    async def run():
+        governor = LLMGovernor(rpm_limit=600, tpm_limit=0)  # one request every 0.1 s
+        governor.requests.level = 0
+        order = []
+        async def call(name, priority):
+            await governor.acquire(10, priority)
+            order.append(name)
+        batch = [asyncio.create_task(call(f"batch{i}", BATCH)) for i in range(2)]
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(call("interactive", INTERACTIVE))
+        await asyncio.gather(*batch, interactive)
+        return order
+    assert asyncio.run(run()) == ["interactive", "batch0", "batch1"]
+
+def test_settle_refunds_unused_tokens():
+    governor = LLMGovernor(rpm_limit=0, tpm_limit=6000)
+    asyncio.run(governor.acquire(1000))
+    level = governor.tokens.level
+    governor.settle(1000, 200)
+    assert governor.tokens.level == pytest.approx(level + 800, abs=1)
+    governor.settle(100, 300)
+    assert governor.tokens.level == pytest.approx(level + 600, abs=1)
+
+def test_call_cancelled_after_its_grant_returns_the_budget():
+    async def run():
+        governor = LLMGovernor(rpm_limit=0, tpm_limit=600)
+        governor.tokens.level = 0
+        waiter = asyncio.create_task(governor.acquire(5))
+        await asyncio.sleep(0)
+        # Grant it, then cancel the task before it gets to run again
+        governor.tokens.level = 10
+        governor._dispatch()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return governor.tokens.level
+    assert asyncio.run(run()) == pytest.approx(10, abs=0.1)
+
+def test_cancelled_completion_settles_its_estimate(monkeypatch):
+    import llm_client
+    import llm_governor
+
+    class HangingCompletions:
+        async def create(self, **kwargs):
+            await asyncio.sleep(3600)
+
+    class Client:
+        class chat:
+            completions = HangingCompletions()
+
+    governor = LLMGovernor(rpm_limit=0, tpm_limit=60000)
+    monkeypatch.setattr(llm_governor, "_governor", governor)
+    monkeypatch.setattr(llm_client, "get_async_client", lambda: Client())
+
+    async def run():
+        call = asyncio.create_task(llm_client.chat_completion(
+            [{"role": "user", "content": "x" * 400}], 0, 1000, use_cache=False))
+        await asyncio.sleep(0.01)
+        during = governor.tokens.level
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        return during, governor.tokens.level
+    during, after = asyncio.run(run())
+    assert during == pytest.approx(60000 - 1100, abs=5)
+    assert after == pytest.approx(60000, abs=5)
@@ -0,0 +1,49 @@
+"""
+Tests for zip_stream (run with: python -m pytest test_zip_stream.py)
+"""
+import io
+import os
+import zipfile
+
+from zip_stream import ZipStreamWriter, stream_zip, write_zip
+
+def test_stream_zip_is_a_valid_archive(tmp_path):
+    report = tmp_path / "report.json"
+    report.write_bytes(b'{"test_cases": []}' * 1000)
+    workbook = tmp_path / "book.xlsx"
+    workbook.write_bytes(os.urandom(50000))
+    entries = [
+        ("TestCases/report.json", report),
+        ("Excel/book.xlsx", workbook),
+        ("notes.txt", b"hello"),
+        ("missing.json", tmp_path / "missing.json")
+    ]
+    data = b"".join(stream_zip(entries, chunk_size=4096))
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ["TestCases/report.json", "Excel/book.xlsx", "notes.txt"]
+        assert archive.read("Excel/book.xlsx") == workbook.read_bytes()
+        assert archive.read("notes.txt") == b"hello"
+        # Office files are already compressed and stored as they are
+        assert archive.getinfo("Excel/book.xlsx").compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo("TestCases/report.json").compress_type == zipfile.ZIP_DEFLATED
+
+def test_docx_is_stored():
+    data = b"".join(stream_zip([("UserStory/doc_userstory.docx", b"PK" + os.urandom(1000))]))
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.getinfo("UserStory/doc_userstory.docx").compress_type == zipfile.ZIP_STORED
+
+def test_writer_yields_entries_as_they_are_added():
+    writer = ZipStreamWriter()
+    first = b"".join(writer.add("a.txt", b"a" * 100))
+    assert first
+    data = first + b"".join(writer.add("b.txt", b"b" * 100)) + writer.close()
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.read("b.txt") == b"b" * 100
+
+def test_write_zip_leaves_no_partial_file(tmp_path):
+    target = write_zip(tmp_path / "out.zip", [("a.txt", b"a")])
+    assert zipfile.ZipFile(target).testzip() is None
+    assert [path.name for path in tmp_path.iterdir()] == ["out.zip"]
@@ -0,0 +1,281 @@
+"""
+Storage for uploaded documents and their extracted text
+
+Uploads are keyed by the SHA-256 of the file content plus the filename, and
+looked up by filename (the most recent upload under a name wins). Metadata
+and text are kept apart so that listing uploads never loads document text.
+The SQLite backend is shared by every worker process and survives restarts;
+the memory backend keeps the previous single-process behaviour.
+
+Each document also has a fingerprint of its normalized text, so a re-saved
+or renamed copy of a document is recognised. Agent results are stored per
+text fingerprint and pipeline (deployment and prompt version) as artifacts,
+and reused for every upload of the same text until they expire.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+UPLOAD_STORE = os.getenv("UPLOAD_STORE", "sqlite").lower()
+UPLOAD_STORE_PATH = Path(os.getenv("UPLOAD_STORE_PATH", str(Path(__file__).parent / ".cache" / "uploads.db")))
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def normalize_text(text: str) -> str:
+    """Canonical form of extracted text: NFKC with runs of whitespace collapsed"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+class UploadStore:
+    """Interface of the upload stores"""
+
+    def put(self, filename: str, file_hash: str, text: str, size: int) -> dict:
+        """Store an upload and return its metadata"""
+        raise NotImplementedError
+
+    def get_document(self, file_hash: str) -> Optional[str]:
+        """Extracted text of a previously uploaded file with this content hash"""
+        raise NotImplementedError
+
+    def find_duplicates(self, file_hash: str, document_hash: str, exclude: str = None) -> List[dict]:
+        """Latest uploads (other than exclude) with the same file content or normalized text"""
+        raise NotImplementedError
+
+    def save_artifact(self, document_hash: str, pipeline: str, stage: str, output, file_name: str, run_id: str):
+        """Record an agent result for a document's text fingerprint produced by pipeline"""
+        raise NotImplementedError
+
+    def get_artifacts(self, document_hash: str, pipeline: str, max_age: float) -> dict:
+        """Agent results of pipeline recorded in the last max_age seconds: {stage: {"output", "file_name", "run_id", "created_at"}}"""
+        raise NotImplementedError
+
+    def get(self, filename: str) -> Optional[dict]:
+        """Metadata of the latest upload under filename"""
+        raise NotImplementedError
+
+    def get_content(self, filename: str) -> Optional[str]:
+        """Extracted text of the latest upload under filename"""
+        raise NotImplementedError
+
+    def list(self) -> List[dict]:
+        """Metadata of the latest upload under each filename, oldest first"""
+        raise NotImplementedError
+
+    def __contains__(self, filename: str) -> bool:
+        return self.get(filename) is not None
+
+def _metadata(filename: str, file_hash: str, document_hash: str, size: int, text_length: int, uploaded_at: str) -> dict:
+    return {
+        "filename": filename,
+        "content_hash": file_hash,
+        "text_hash": document_hash,
+        "size": size,
+        "text_length": text_length,
+        "uploaded_at": uploaded_at
+    }
+
+class MemoryUploadStore(UploadStore):
+    """Per-process store; contents are lost on restart"""
+
+    def __init__(self):
+        self._uploads = {}    # filename -> metadata
+        self._texts = {}      # content hash -> text
+        self._artifacts = {}  # (text hash, pipeline) -> {stage: artifact}
+        self._lock = threading.Lock()
+
+    def put(self, filename: str, file_hash: str, text: str, size: int) -> dict:
+        metadata = _metadata(filename, file_hash, text_hash(text), size, len(text), datetime.now().isoformat())
+        with self._lock:
+            self._texts[file_hash] = text
+            # Re-inserting moves the name to the end, like a newer upload in SQLite
+            self._uploads.pop(filename, None)
+            self._uploads[filename] = metadata
+        return dict(metadata)
+
+    def get(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            metadata = self._uploads.get(filename)
+        return dict(metadata) if metadata else None
+
+    def get_content(self, filename: str) -> Optional[str]:
+        with self._lock:
+            metadata = self._uploads.get(filename)
+            return self._texts.get(metadata["content_hash"]) if metadata else None
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            return [dict(metadata) for metadata in self._uploads.values()]
+
+    def get_document(self, file_hash: str) -> Optional[str]:
+        with self._lock:
+            return self._texts.get(file_hash)
+
+    def find_duplicates(self, file_hash: str, document_hash: str, exclude: str = None) -> List[dict]:
+        with self._lock:
+            return [
+                dict(metadata) for name, metadata in self._uploads.items()
+                if name != exclude and (metadata["content_hash"] == file_hash or metadata["text_hash"] == document_hash)
+            ]
+
+    def save_artifact(self, document_hash: str, pipeline: str, stage: str, output, file_name: str, run_id: str):
+        artifact = {"output": output, "file_name": file_name, "run_id": run_id, "created_at": time.time()}
+        with self._lock:
+            self._artifacts.setdefault((document_hash, pipeline), {})[stage] = artifact
+
+    def get_artifacts(self, document_hash: str, pipeline: str, max_age: float) -> dict:
+        oldest = time.time() - max_age
+        with self._lock:
+            artifacts = self._artifacts.get((document_hash, pipeline), {})
+            return {stage: dict(artifact) for stage, artifact in artifacts.items() if artifact["created_at"] >= oldest}
+
+class SQLiteUploadStore(UploadStore):
+    """Store shared by all worker processes through a SQLite database"""
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS documents (
+                    content_hash TEXT PRIMARY KEY,
+                    text_hash TEXT NOT NULL,
+                    text TEXT NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_text_hash ON documents(text_hash)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS uploads (
+                    content_hash TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    text_length INTEGER NOT NULL,
+                    uploaded_at TEXT NOT NULL,
+                    PRIMARY KEY (content_hash, filename)
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_filename ON uploads(filename, uploaded_at)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS artifacts (
+                    text_hash TEXT NOT NULL,
+                    pipeline TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    output TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    run_id TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (text_hash, pipeline, stage)
+                )"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        """Connection for one operation: committed (or rolled back) and closed on exit"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def put(self, filename: str, file_hash: str, text: str, size: int) -> dict:
+        uploaded_at = datetime.now().isoformat()
+        document_hash = text_hash(text)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO documents (content_hash, text_hash, text) VALUES (?, ?, ?)",
+                (file_hash, document_hash, text)
+            )
+            conn.execute(
+                """INSERT INTO uploads (content_hash, filename, size, text_length, uploaded_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (content_hash, filename) DO UPDATE SET uploaded_at = excluded.uploaded_at""",
+                (file_hash, filename, size, len(text), uploaded_at)
+            )
+        return _metadata(filename, file_hash, document_hash, size, len(text), uploaded_at)
+
+    def get(self, filename: str) -> Optional[dict]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT u.filename, u.content_hash, d.text_hash, u.size, u.text_length, u.uploaded_at "
+                "FROM uploads u JOIN documents d ON d.content_hash = u.content_hash "
+                "WHERE u.filename = ? ORDER BY u.uploaded_at DESC LIMIT 1",
+                (filename,)
+            ).fetchone()
+        return _metadata(*row) if row else None
+
+    def get_content(self, filename: str) -> Optional[str]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT d.text FROM uploads u JOIN documents d ON d.content_hash = u.content_hash "
+                "WHERE u.filename = ? ORDER BY u.uploaded_at DESC LIMIT 1",
+                (filename,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def list(self) -> List[dict]:
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                """SELECT u.filename, u.content_hash, d.text_hash, u.size, u.text_length, MAX(u.uploaded_at)
+                FROM uploads u JOIN documents d ON d.content_hash = u.content_hash
+                GROUP BY u.filename ORDER BY MAX(u.uploaded_at)"""
+            ).fetchall()
+        return [_metadata(*row) for row in rows]
+
+    def get_document(self, file_hash: str) -> Optional[str]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT text FROM documents WHERE content_hash = ?", (file_hash,)).fetchone()
+        return row[0] if row else None
+
+    def find_duplicates(self, file_hash: str, document_hash: str, exclude: str = None) -> List[dict]:
+        # Candidate names first, then keep those whose latest upload still matches
+        with self._lock, self._connect() as conn:
+            names = [row[0] for row in conn.execute(
+                """SELECT DISTINCT u.filename FROM uploads u JOIN documents d ON d.content_hash = u.content_hash
+                WHERE (u.content_hash = ? OR d.text_hash = ?) AND u.filename != ?""",
+                (file_hash, document_hash, exclude or "")
+            )]
+        duplicates = []
+        for name in names:
+            metadata = self.get(name)
+            if metadata and (metadata["content_hash"] == file_hash or metadata["text_hash"] == document_hash):
+                duplicates.append(metadata)
+        return duplicates
+
+    def save_artifact(self, document_hash: str, pipeline: str, stage: str, output, file_name: str, run_id: str):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO artifacts (text_hash, pipeline, stage, output, file_name, run_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (document_hash, pipeline, stage, json.dumps(output), file_name, run_id, time.time())
+            )
+
+    def get_artifacts(self, document_hash: str, pipeline: str, max_age: float) -> dict:
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT stage, output, file_name, run_id, created_at FROM artifacts "
+                "WHERE text_hash = ? AND pipeline = ? AND created_at >= ?",
+                (document_hash, pipeline, time.time() - max_age)
+            ).fetchall()
+        return {
+            stage: {"output": json.loads(output), "file_name": file_name, "run_id": run_id, "created_at": created_at}
+            for stage, output, file_name, run_id, created_at in rows
+        }
+
+def create_upload_store() -> UploadStore:
+    """Create the store selected by UPLOAD_STORE ("sqlite" or "memory")"""
+    if UPLOAD_STORE == "memory":
+        return MemoryUploadStore()
+    if UPLOAD_STORE != "sqlite":
+        print(f"Warning: unknown UPLOAD_STORE '{UPLOAD_STORE}', using sqlite")
+    return SQLiteUploadStore(UPLOAD_STORE_PATH)
@@ -0,0 +1,117 @@
+"""
+Streaming ZIP archives
+
+stream_zip() yields an archive chunk by chunk while it is being built, so a
+download starts with the first compressed bytes and memory use is bounded by
+the chunk size instead of the archive size. zipfile writes to an unseekable
+sink in streaming mode (sizes and CRCs follow each entry in a data
+descriptor), which all common unzip tools read through the central directory.
+
+Files that are already compressed (Office documents, archives, images) are
+stored instead of being deflated a second time.
+"""
+import io
+import os
+import time
+import uuid
+import zipfile
+from pathlib import Path
+from typing import Iterable, Iterator, Tuple, Union
+
+ZIP_CHUNK_SIZE = 256 * 1024
+
+# Already zip- or otherwise compressed formats
+STORED_EXTENSIONS = {".docx", ".xlsx", ".pptx", ".zip", ".gz", ".png", ".jpg", ".jpeg", ".gif"}
+
+class _Sink(io.RawIOBase):
+    """Unseekable output that hands back what has been written since the last drain"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def compression_for(arcname: str) -> int:
+    return zipfile.ZIP_STORED if Path(arcname).suffix.lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+class ZipStreamWriter:
+    """Incremental form of stream_zip, for archives whose entries become available over time
+
+    add() and close() return the archive bytes produced by that step.
+    """
+
+    def __init__(self, chunk_size: int = ZIP_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._sink = _Sink()
+        self._zip_file = zipfile.ZipFile(self._sink, "w")
+
+    def add(self, arcname: str, source: Union[Path, bytes]) -> Iterator[bytes]:
+        """Yield the bytes of one entry (nothing if source is a missing file)"""
+        if isinstance(source, (bytes, bytearray)):
+            info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+            info.file_size = len(source)
+            info.external_attr = 0o644 << 16
+            reader = io.BytesIO(source)
+        else:
+            try:
+                info = zipfile.ZipInfo.from_file(source, arcname)
+                reader = open(source, "rb")
+            except FileNotFoundError:
+                return
+        info.compress_type = compression_for(arcname)
+        with reader, self._zip_file.open(info, "w") as writer:
+            while True:
+                data = reader.read(self.chunk_size)
+                if not data:
+                    break
+                writer.write(data)
+                output = self._sink.drain()
+                if output:
+                    yield output
+        output = self._sink.drain()
+        if output:
+            yield output
+
+    def close(self) -> bytes:
+        """Finish the archive and return the central directory"""
+        self._zip_file.close()
+        return self._sink.drain()
+
+def stream_zip(entries: Iterable[Tuple[str, Union[Path, bytes]]], chunk_size: int = ZIP_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield a ZIP archive of (arcname, file path or bytes) entries as it is written
+
+    Entries are consumed lazily; missing files are skipped.
+    """
+    writer = ZipStreamWriter(chunk_size)
+    for arcname, source in entries:
+        yield from writer.add(arcname, source)
+    yield writer.close()
+
+def write_zip(zip_path: Path, entries: Iterable[Tuple[str, Union[Path, bytes]]]) -> Path:
+    """Write a ZIP archive to zip_path through a temporary file, so readers never see it half-written"""
+    zip_path = Path(zip_path)
+    partial_path = zip_path.with_name(f".{zip_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(partial_path, "wb") as output:
+            for data in stream_zip(entries):
+                output.write(data)
+        os.replace(partial_path, zip_path)
+    finally:
+        if partial_path.exists():
+            partial_path.unlink()
+    return zip_path